@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+import numpy as np
+
+
+#
+# Set defaults
+#
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+DATASETS = {
+    'mnist':            dict(script='capsnet', input_shape=(28, 28, 1), n_class=10, out_dim=16, convnet=True),
+    'cifar10':          dict(script='capsnet', input_shape=(32, 32, 3), n_class=11, out_dim=42, convnet=True),
+    'symmetric_forms':  dict(script='main', input_shape=(28, 28, 3), n_class=2, out_dim=3, convnet=False),
+}
+
+
+#
+# Main
+#
+def main(args):
+    """ Run one worker process per dataset and thread count. Each dataset directory has its
+        own capsule.py and utils.py, and TF thread pools are fixed per session, so a fresh
+        process is the only clean way to separate them.
+    """
+    results = []
+    for dataset in args.datasets:
+        for threads in args.threads:
+            print("=" * 40 + " %s, threads=%d " % (dataset, threads) + "=" * 40)
+            cmd = [sys.executable, os.path.abspath(__file__), '--worker',
+                   '--datasets', dataset,
+                   '--threads', str(threads),
+                   '--batch_sizes'] + [str(b) for b in args.batch_sizes] + [
+                   '--warmup', str(args.warmup),
+                   '--repeats', str(args.repeats),
+                   '--num_routing', str(args.num_routing)]
+            output = subprocess.check_output(cmd, cwd=os.path.join(ROOT_DIR, dataset))
+            for line in output.decode('utf-8').splitlines():
+                if line.startswith('{'):
+                    results.append(json.loads(line))
+
+    add_speedup(results)
+    with open(args.output, 'w') as out:
+        json.dump({'meta': _meta(), 'results': results}, out, indent=2)
+    print_summary(results)
+    print("Benchmark results saved to %s" % args.output)
+
+
+def run_worker(args):
+    """ Build all models of one dataset with random weights and measure them.
+        Every result is printed as one JSON line to stdout.
+    """
+    dataset = args.datasets[0]
+    threads = args.threads[0]
+    spec = DATASETS[dataset]
+    sys.path.insert(0, os.path.join(ROOT_DIR, dataset))
+
+    import tensorflow as tf
+    from keras import backend as K
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)
+    K.set_session(tf.Session(config=config))
+    K.set_learning_phase(0)
+
+    for name, model in build_models(dataset, spec, args.num_routing):
+        for batch_size in args.batch_sizes:
+            record = dict(dataset=dataset, model=name, threads=threads, batch_size=batch_size,
+                          params=int(model.count_params()))
+            try:
+                record.update(measure(model, spec['input_shape'], batch_size, args.warmup, args.repeats))
+            except (tf.errors.ResourceExhaustedError, MemoryError) as e:
+                record['error'] = type(e).__name__
+            print(json.dumps(record))
+            sys.stdout.flush()
+
+            # Larger batches will not fit either
+            if 'error' in record:
+                break
+
+
+def build_models(dataset, spec, num_routing):
+    """ Return (name, model) pairs of the CapsNet eval_model, the classification-only
+        model (up to Length) and, if available, the convnet baseline of the dataset.
+    """
+    capsnet = __import__(spec['script'])
+
+    if dataset == 'mnist':
+        capsnet_models = capsnet.create_capsnet(spec['input_shape'], spec['n_class'], num_routing)
+    else:
+        capsnet_models = capsnet.create_capsnet(spec['input_shape'], spec['n_class'], spec['out_dim'], num_routing)
+
+    # eval_model and the classification-only model of the training script
+    yield 'capsnet_eval', capsnet_models[1]
+    yield 'capsnet_classify', capsnet_models[3]
+
+    if spec['convnet']:
+        import convnet
+        yield 'convnet', convnet.create_convnet(spec['input_shape'], spec['n_class'])
+
+
+def measure(model, input_shape, batch_size, warmup, repeats):
+    """ Measure the latency of model.predict_on_batch for one batch size on random inputs.
+    """
+    x = np.random.rand(batch_size, *input_shape).astype('float32')
+    for _ in range(warmup):
+        model.predict_on_batch(x)
+
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.predict_on_batch(x)
+        latencies.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies) * 1000
+    return dict(images_per_sec=batch_size * repeats / (latencies.sum() / 1000),
+                latency_ms_mean=float(latencies.mean()),
+                latency_ms_p50=float(np.percentile(latencies, 50)),
+                latency_ms_p95=float(np.percentile(latencies, 95)),
+                latency_ms_p99=float(np.percentile(latencies, 99)))
+
+
+def add_speedup(results):
+    """ Add the throughput relative to capsnet_eval with the same dataset, threads and batch size.
+    """
+    eval_results = {(r['dataset'], r['threads'], r['batch_size']): r for r in results
+                    if r['model'] == 'capsnet_eval' and 'error' not in r}
+    for r in results:
+        baseline = eval_results.get((r['dataset'], r['threads'], r['batch_size']))
+        if baseline is not None and 'error' not in r:
+            r['speedup_vs_eval'] = r['images_per_sec'] / baseline['images_per_sec']
+
+
+def print_summary(results):
+    print("\n%-16s %-18s %7s %6s %12s %10s %10s %10s %8s" % ("dataset", "model", "threads", "batch",
+                                                             "images/sec", "p50 [ms]", "p95 [ms]", "p99 [ms]", "vs eval"))
+    for r in results:
+        if 'error' in r:
+            print("%-16s %-18s %7d %6d %12s" % (r['dataset'], r['model'], r['threads'], r['batch_size'], r['error']))
+            continue
+        print("%-16s %-18s %7d %6d %12.1f %10.2f %10.2f %10.2f %7.2fx" % (r['dataset'], r['model'], r['threads'], r['batch_size'],
+              r['images_per_sec'], r['latency_ms_p50'], r['latency_ms_p95'], r['latency_ms_p99'],
+              r.get('speedup_vs_eval', float('nan'))))
+
+
+def _meta():
+    return dict(hostname=socket.gethostname(),
+                cpu_count=os.cpu_count(),
+                time=time.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+#
+# Main
+#
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inference benchmark of all CapsNet and ConvNet models on random weights.")
+    parser.add_argument('--datasets', nargs='+', default=sorted(DATASETS.keys()), choices=sorted(DATASETS.keys()))
+
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 2, 4, 8, 16, 32, 64, 128, 256, 512])
+
+    parser.add_argument('--threads', nargs='+', type=int, default=[1, 4, 0],
+                        help="Intra- and inter-op thread counts of the TF session. 0 uses the TF default")
+
+    parser.add_argument('--warmup', default=3, type=int,
+                        help="Number of untimed predictions per batch size")
+
+    parser.add_argument('--repeats', default=20, type=int,
+                        help="Number of timed predictions per batch size")
+
+    parser.add_argument('-r', '--num_routing', default=3, type=int,
+                        help="Number of iterations used in routing algorithm. should > 0")
+
+    parser.add_argument('--output', default='benchmark.json',
+                        help="JSON file for the results")
+
+    parser.add_argument('--worker', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+    else:
+        main(args)
@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+import numpy as np
+
+
+#
+# Set defaults
+#
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# All sweeps change one parameter of this configuration (MNIST configuration of [1])
+BASE_CONFIG = dict(num_routing=3, input_num_capsule=1152, input_dim_vector=8,
+                   num_capsule=10, dim_vector=16, batch_size=16)
+
+SWEEPS = dict(num_routing=[1, 2, 3, 4, 5, 6],
+              input_num_capsule=[288, 576, 1152, 2304, 4096],
+              num_capsule=[2, 5, 10, 11, 20],
+              dim_vector=[3, 8, 16, 32, 42],
+              batch_size=[1, 4, 16, 32, 64])
+
+
+#
+# Main
+#
+def main(args):
+    """ Run every configuration in a fresh process. Peak RSS can only grow during the
+        lifetime of a process, so this is the only way to measure the peak per configuration.
+    """
+    records = []
+    for param in args.params:
+        for value in SWEEPS[param]:
+            config = dict(BASE_CONFIG)
+            config[param] = value
+            config['recompute_routing'] = args.recompute_routing
+            print("%s = %d" % (param, value))
+
+            cmd = [sys.executable, os.path.abspath(__file__), '--worker', '--dataset', args.dataset,
+                   '--warmup', str(args.warmup), '--repeats', str(args.repeats),
+                   '--config', json.dumps(config)]
+            try:
+                output = subprocess.check_output(cmd, cwd=os.path.join(ROOT_DIR, args.dataset))
+                record = json.loads(output.decode('utf-8').splitlines()[-1])
+            except subprocess.CalledProcessError:
+                record = dict(config, error='worker failed (probably out of memory)')
+            record['sweep'] = param
+            records.append(record)
+
+    fits = fit_scaling(records)
+    with open(args.output, 'w') as out:
+        json.dump({'base_config': BASE_CONFIG, 'results': records, 'fits': fits}, out, indent=2)
+
+    print_summary(records, fits)
+    print("Results saved to %s" % args.output)
+
+
+def run_worker(args):
+    """ Measure forward and forward+backward time and peak memory of one configuration.
+    """
+    sys.path.insert(0, os.path.join(ROOT_DIR, args.dataset))
+    config = json.loads(args.config)
+
+    from keras import backend as K
+    from capsule import CapsuleLayer, squashing
+
+    u = K.placeholder(shape=(None, config['input_num_capsule'], config['input_dim_vector']))
+    layer = CapsuleLayer(num_capsule=config['num_capsule'], dim_vector=config['dim_vector'],
+                         num_routing=config['num_routing'],
+                         recompute_routing=config.get('recompute_routing', False))
+    v = layer(u)
+
+    forward = K.function([u], [v])
+    backward = K.function([u], K.gradients(K.sum(v), [layer.W, u]))
+    squash_forward = K.function([u], [squashing(u)])
+    squash_backward = K.function([u], K.gradients(K.sum(squashing(u)), [u]))
+
+    x = np.random.rand(config['batch_size'], config['input_num_capsule'], config['input_dim_vector']).astype('float32')
+    record = dict(config)
+    record['params'] = int(np.prod(K.int_shape(layer.W)))
+
+    # Create the session (thread pools, initialized weights) and run one small op before the
+    # baseline, so the peaks only contain the memory of the measured configuration. ru_maxrss
+    # never decreases, so the warm-up must not run the layer on the full batch
+    K.get_session()
+    squash_forward([x[:1]])
+    rss_baseline = _peak_rss_mb()
+    record['forward_ms'] = _time(forward, x, args.warmup, args.repeats)
+    record['forward_peak_mb'] = _peak_rss_mb() - rss_baseline
+    record['backward_ms'] = _time(backward, x, args.warmup, args.repeats)
+    record['backward_peak_mb'] = _peak_rss_mb() - rss_baseline
+    record['squashing_forward_ms'] = _time(squash_forward, x, args.warmup, args.repeats)
+    record['squashing_backward_ms'] = _time(squash_backward, x, args.warmup, args.repeats)
+    print(json.dumps(record))
+
+
+def fit_scaling(records):
+    """ Fit y = c * x^k in log-log space for every swept parameter and measured value.
+
+        :return Dict sweep -> measure -> dict(c, k)
+    """
+    fits = {}
+    for param in SWEEPS:
+        rows = [r for r in records if r['sweep'] == param and 'error' not in r]
+        if len(rows) < 2:
+            continue
+
+        fits[param] = {}
+        x = np.log([r[param] for r in rows])
+        for measure in ['forward_ms', 'backward_ms', 'forward_peak_mb', 'backward_peak_mb']:
+            y = np.array([r[measure] for r in rows], dtype=np.float64)
+            if np.any(y <= 0):
+                continue
+            k, log_c = np.polyfit(x, np.log(y), 1)
+            fits[param][measure] = dict(c=float(np.exp(log_c)), k=float(k))
+    return fits
+
+
+def print_summary(records, fits):
+    print("\n%-18s %6s %12s %12s %12s %12s" % ("sweep", "value", "fwd [ms]", "fwd+bwd [ms]", "fwd [MB]", "fwd+bwd [MB]"))
+    for r in records:
+        if 'error' in r:
+            print("%-18s %6d %s" % (r['sweep'], r[r['sweep']], r['error']))
+            continue
+        print("%-18s %6d %12.2f %12.2f %12.1f %12.1f" % (r['sweep'], r[r['sweep']], r['forward_ms'],
+              r['backward_ms'], r['forward_peak_mb'], r['backward_peak_mb']))
+
+    print("\nScaling y = c * x^k")
+    for param, measures in sorted(fits.items()):
+        print("  " + param + ": " + ", ".join("%s k=%.2f" % (m, f['k']) for m, f in sorted(measures.items())))
+
+
+def _time(fn, x, warmup, repeats):
+    """ Median time in ms of fn([x])
+    """
+    for _ in range(warmup):
+        fn([x])
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn([x])
+        times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1000)
+
+
+def _peak_rss_mb():
+    # ru_maxrss is given in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+#
+# Main
+#
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark of CapsuleLayer and squashing.")
+    parser.add_argument('--dataset', default='cifar10', choices=['mnist', 'cifar10', 'symmetric_forms'],
+                        help="Directory whose capsule.py is benchmarked")
+
+    parser.add_argument('--params', nargs='+', default=sorted(SWEEPS.keys()), choices=sorted(SWEEPS.keys()),
+                        help="Parameters to sweep. All other parameters are set to BASE_CONFIG")
+
+    parser.add_argument('--recompute_routing', action='store_true',
+                        help="Benchmark the CapsuleLayer with recomputation of the routing in the backward pass")
+
+    parser.add_argument('--warmup', default=2, type=int)
+
+    parser.add_argument('--repeats', default=10, type=int)
+
+    parser.add_argument('--output', default='benchmark_capsule.json',
+                        help="JSON file for the results")
+
+    parser.add_argument('--worker', action='store_true',
+                        help=argparse.SUPPRESS)
+
+    parser.add_argument('--config', default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+    else:
+        main(args)
@@ -5,6 +5,11 @@ import numpy as np
 from PIL import Image
 import matplotlib.pyplot as plt
 
+# OpenMP and MKL read their thread settings when TF is loaded, so the process is pinned before keras is imported
+import pinning
+if __name__ == "__main__":
+    pinning.pin_from_argv(sys.argv[1:])
+
 import keras
 from keras import callbacks, layers, models, optimizers
 from keras import backend as K
@@ -12,14 +17,23 @@ from keras.utils import to_categorical
 from keras.datasets import cifar10
 from keras.preprocessing.image import ImageDataGenerator
 
-from sklearn.metrics import confusion_matrix, f1_score, accuracy_score, recall_score, precision_score
-
 import foolbox
 from foolbox.attacks import LBFGSAttack
 from foolbox.criteria import TargetClassProbability
 
 import utils
-from capsule import PrimaryCaps, CapsuleLayer, Length, Mask, margin_loss, reconstruction_loss
+import monitor
+import session_config
+import probe
+import parallel
+import freeze
+import quantize
+import mmweights
+import prune
+import distill
+from accumulate import AdamAccumulate
+from checkpoint import AsyncCheckpoint
+from capsule import PrimaryCaps, CapsuleLayer, FactorizedCapsuleLayer, factorize_weights, Length, Mask, ClassConditionalDense, margin_loss, reconstruction_loss
 
 
 #
@@ -38,14 +52,25 @@ def main(args):
     if not os.path.exists(args.save_dir):
             os.makedirs(args.save_dir)
 
+    # Without display we never show plots
+    if args.headless:
+        plt.switch_backend('Agg')
+
     # Save args into file 
     if not args.testing:
         with open(args.save_dir+"/args.txt", "w") as out:
             sorted_args = sorted(vars(args).items())
             out.write('\n'.join("{0} = {1}".format(a, v) for (a, v) in sorted_args))
 
+    # Configure threads and pinning before the first session is created, otherwise TF keeps its defaults
+    if args.intra_op_threads or args.inter_op_threads or args.cpus is not None or args.numa_node is not None:
+        session = session_config.configure_session(args.intra_op_threads, args.inter_op_threads, args.cpus, args.numa_node)
+        if not args.testing:
+            session_config.log_config(session, args.save_dir + "/args.txt")
+
     # Set learning phase for tf
-    if args.testing or args.fool:
+    if args.testing or args.fool or args.export_routing is not None or args.freeze is not None \
+            or args.quantize is not None or args.prune_report is not None:
         keras.backend.set_learning_phase(0)
 
     # Load data
@@ -68,12 +93,28 @@ def main(args):
     model, eval_model, manipulate_model, fool_model = create_capsnet(shape,
                                                   n_class=n_class,
                                                   out_dim=capsnet_out_dim,
-                                                  num_routing=args.num_routing)
+                                                  num_routing=args.num_routing,
+                                                  recompute_routing=args.recompute_routing,
+                                                  dense_decoder=args.dense_decoder,
+                                                  capsule_rank=args.capsule_rank,
+                                                  conv1_filters=args.conv1_filters,
+                                                  primary_channels=args.primary_channels)
     model.summary()
 
     # Run training / testing
-    if args.weights is not None and os.path.exists(args.weights):
-        model.load_weights(args.weights)
+    if args.factorize:
+        # The weights file contains a dense caps1, so it is converted instead of loaded
+        print("\n" + "=" * 40 + " FACTORIZE " + "=" * 36)
+        factorize_capsnet(model, args.weights, shape, n_class, args)
+        model.save_weights(args.save_dir + '/factorized_model.hdf5')
+        print("Factorized weights saved to %s" % (args.save_dir + '/factorized_model.hdf5'))
+        sys.exit(0)
+    elif args.weights is not None and os.path.exists(args.weights):
+        # .mmw files are memory-mapped (see mmweights.py), all others are HDF5
+        if args.weights.endswith('.mmw'):
+            mmweights.load_weights(model, args.weights)
+        else:
+            model.load_weights(args.weights)
         print("Successfully loaded weights file %s" % args.weights)
     else:
         print('(Warning) No weights are provided, using random initialized weights.')
@@ -81,13 +122,65 @@ def main(args):
     # Run test / fool / train
     if args.testing:
         print("\n" + "=" * 40 + " TEST =" + "=" * 40)
-        test(model=eval_model, data=(x_test, y_test), args=args)
-        manipulate_latent(manipulate_model, n_class, capsnet_out_dim, (x_test, y_test), args)
+        writer = utils.ArtifactWriter(args.save_dir, headless=args.headless)
+        # Pruned weights: input capsules without blocks are dropped from u_hat and routing
+        test_model = fool_model
+        caps1 = fool_model.get_layer('caps1')
+        if args.capsule_rank is None and len(prune.kept_input_capsules(caps1.get_weights()[0])) < caps1.input_num_capsule:
+            test_model, num_kept = prune.build_sparse_model(fool_model, 'caps1')
+            print("Testing the sparse model with %d of %d input capsules" % (num_kept, caps1.input_num_capsule))
+        test(model=test_model, recon_model=eval_model, data=(x_test, y_test), args=args, writer=writer)
+        manipulate_latent(manipulate_model, n_class, capsnet_out_dim, (x_test, y_test), args, writer)
+        writer.close()
     
     elif args.fool:
         print("\n" + "=" * 40 + " FOOL =" + "=" * 40)
         adversarial_attack(fool_model, x_test, y_test)
 
+    elif args.scaling_study:
+        print("\n" + "=" * 40 + " SCALING " + "=" * 38)
+        x_batch, y_batch = x_train[:args.batch_size], y_train[:args.batch_size]
+        if args.crop_x is not None and args.crop_y is not None:
+            x_batch = utils.center_crop(x_batch, [args.crop_x, args.crop_y])
+        build_args = (shape, n_class, args.num_routing, args.recompute_routing, args.dense_decoder, args.capsule_rank,
+                      args.conv1_filters, args.primary_channels)
+        results = parallel.scaling_study(model, build_train_model, build_args,
+                                         parallel_compile_args(args), ([x_batch, y_batch], [y_batch, x_batch]),
+                                         max_workers=args.workers)
+        parallel.save_scaling_study(results, args.save_dir + '/scaling.json')
+
+    elif args.quantize is not None:
+        print("\n" + "=" * 40 + " QUANTIZE " + "=" * 37)
+        x_calibration, x_eval = x_train[:args.calibration_samples], x_test
+        if args.crop_x is not None and args.crop_y is not None:
+            x_calibration = utils.center_crop(x_calibration, [args.crop_x, args.crop_y])
+            x_eval = utils.center_crop(x_eval, [args.crop_x, args.crop_y])
+        quantize.run(fool_model, x_calibration, (x_eval, y_test), args.quantize,
+                     report_path=args.save_dir + '/quantize_report.json')
+
+    elif args.prune_report is not None:
+        print("\n" + "=" * 40 + " PRUNE " + "=" * 40)
+        x_eval = x_test
+        if args.crop_x is not None and args.crop_y is not None:
+            x_eval = utils.center_crop(x_eval, [args.crop_x, args.crop_y])
+        prune.report(fool_model, 'caps1', (x_eval, y_test), args.prune_report,
+                     granularity=args.prune_granularity, label=args.weights)
+
+    elif args.distill is not None:
+        print("\n" + "=" * 40 + " DISTILL " + "=" * 38)
+        distill_capsnet(model, fool_model, shape, n_class, ((x_train, y_train), (x_test, y_test)), args)
+
+    elif args.freeze is not None:
+        print("\n" + "=" * 40 + " FREEZE " + "=" * 39)
+        freeze.freeze_model(eval_model, args.freeze, K.get_session())
+
+    elif args.export_routing is not None:
+        print("\n" + "=" * 40 + " EXPORT " + "=" * 39)
+        x_export = x_test if args.export_split == 'test' else x_train
+        if args.crop_x is not None and args.crop_y is not None:
+            x_export = utils.center_crop(x_export, [args.crop_x, args.crop_y])
+        probe.export_routing(eval_model, 'caps1', x_export, args.export_routing)
+
     else:
         print("\n" + "=" * 40 + " TRAIN " + "=" * 40)
         train(model=model, data=((x_train, y_train), (x_test, y_test)), args=args)
@@ -114,22 +207,34 @@ def load_dataset(with_non_of_the_above_class):
     return (x_train, y_train), (x_test, y_test), n_class
 
 
-def create_capsnet(input_shape, n_class, out_dim, num_routing):
+def create_capsnet(input_shape, n_class, out_dim, num_routing, recompute_routing=False, dense_decoder=False,
+                   capsule_rank=None, conv1_filters=256, primary_channels=64):
     # Create CapsNet
     x = layers.Input(shape=input_shape)
-    conv1 = layers.Conv2D(filters=256, kernel_size=9, strides=1, padding='valid', activation='relu', name='conv1')(x)
-    primary_caps = PrimaryCaps(layer_input=conv1, name='primary_caps', dim_capsule=8, channels=64, kernel_size=9, strides=2)
-    caps1 = CapsuleLayer(num_capsule=n_class, dim_vector=out_dim, num_routing=num_routing)(primary_caps)
+    conv1 = layers.Conv2D(filters=conv1_filters, kernel_size=9, strides=1, padding='valid', activation='relu', name='conv1')(x)
+    primary_caps = PrimaryCaps(layer_input=conv1, name='primary_caps', dim_capsule=8, channels=primary_channels,
+                               kernel_size=9, strides=2)
+    if capsule_rank is None:
+        caps1 = CapsuleLayer(num_capsule=n_class, dim_vector=out_dim, num_routing=num_routing,
+                             recompute_routing=recompute_routing, name='caps1')(primary_caps)
+    else:
+        # Low-rank W_ij = U_j V_ij, see FactorizedCapsuleLayer
+        caps1 = FactorizedCapsuleLayer(num_capsule=n_class, dim_vector=out_dim, num_routing=num_routing,
+                                       rank=capsule_rank, name='caps1')(primary_caps)
     out_caps = Length(name='capsnet')(caps1)
 
     # Create decoder
     y = layers.Input(shape=(n_class,))
-    masked_by_y = Mask()([caps1, y])    # The true label is used to mask the output of capsule layer for training
-    masked = Mask()(caps1)              # Mask using the capsule with maximal length for prediction
+    masked_by_y = Mask(gather=not dense_decoder)([caps1, y])    # The true label is used to mask the output of capsule layer for training
+    masked = Mask(gather=not dense_decoder)(caps1)              # Mask using the capsule with maximal length for prediction
 
     # Shared Decoder model in training and prediction
     decoder = models.Sequential(name='decoder')
-    decoder.add(layers.Dense(512, activation='relu', input_dim=out_dim*n_class))
+    if dense_decoder:
+        decoder.add(layers.Dense(512, activation='relu', input_dim=out_dim*n_class))
+    else:
+        # Same weights as the Dense layer, but only the kernel rows of the selected class are used
+        decoder.add(ClassConditionalDense(512, n_class=n_class, activation='relu', input_shape=(out_dim + 1,)))
     decoder.add(layers.Dense(1024, activation='relu'))
     decoder.add(layers.Dense(np.prod(input_shape), activation='sigmoid'))
     decoder.add(layers.Reshape(target_shape=input_shape, name='decoder_output'))
@@ -137,34 +242,136 @@ def create_capsnet(input_shape, n_class, out_dim, num_routing):
     # Models for training and evaluation (prediction)
     train_model = models.Model([x, y], [out_caps, decoder(masked_by_y)])
     eval_model = models.Model(x, [out_caps, decoder(masked)])
+    # Classification-only model. It stops at Length, so Mask and decoder are not part of its graph
     fool_model = models.Model(x, out_caps)
 
     # manipulate model
     noise = layers.Input(shape=(n_class, out_dim))
     noised_digit_caps = layers.Add()([caps1, noise])
-    masked_noised_y = Mask()([noised_digit_caps, y])
+    masked_noised_y = Mask(gather=not dense_decoder)([noised_digit_caps, y])
     manipulate_model = models.Model([x, y, noise], decoder(masked_noised_y))
 
     return train_model, eval_model, manipulate_model, fool_model
 
 
+def build_train_model(input_shape, n_class, num_routing, recompute_routing=False, dense_decoder=False,
+                      capsule_rank=None, conv1_filters=256, primary_channels=64):
+    """ Create the training model in the worker processes of parallel.py
+    """
+    return create_capsnet(input_shape, n_class=n_class, out_dim=capsnet_out_dim, num_routing=num_routing,
+                          recompute_routing=recompute_routing, dense_decoder=dense_decoder,
+                          capsule_rank=capsule_rank, conv1_filters=conv1_filters,
+                          primary_channels=primary_channels)[0]
+
+
+def factorize_capsnet(model, weights, input_shape, n_class, args):
+    """ Initialize a model with a FactorizedCapsuleLayer from the weights of a trained dense CapsNet.
+        caps1 is factorized by SVD, all other layers are copied by name.
+
+        :param model: Training model created with capsule_rank
+        :param weights: Weights file of the dense model
+    """
+    dense_model = create_capsnet(input_shape, n_class=n_class, out_dim=capsnet_out_dim,
+                                 num_routing=args.num_routing, dense_decoder=args.dense_decoder,
+                                 conv1_filters=args.conv1_filters, primary_channels=args.primary_channels)[0]
+    dense_model.load_weights(weights)
+    print("Successfully loaded weights file %s" % weights)
+
+    for layer in model.layers:
+        if not layer.weights:
+            continue
+        dense_weights = dense_model.get_layer(layer.name).get_weights()
+        if isinstance(layer, FactorizedCapsuleLayer):
+            W = dense_weights[0]
+            V, U = factorize_weights(W, layer.rank)
+            layer.set_weights([V, U])
+            W_approx = np.einsum('ajdr,ajirk->ajidk', U, V)
+            print("%s: rank %d of %d, %d -> %d parameters (%.1f%%), relative error %.4f" % (
+                  layer.name, layer.rank, W.shape[3], W.size, V.size + U.size, 100. * (V.size + U.size) / W.size,
+                  np.linalg.norm(W_approx - W) / np.linalg.norm(W)))
+        else:
+            layer.set_weights(dense_weights)
+
+
+def distill_capsnet(model, fool_model, input_shape, n_class, data, args):
+    """ Train the student (model, e.g. with a smaller --conv1_filters and --primary_channels) on the
+        cached outputs of the full size teacher given via --distill and compare both afterwards.
+        The teacher has the same class capsules, so the pose vectors can be matched.
+    """
+    (x_train, y_train), (x_test, y_test) = data
+    # No random crops, the teacher outputs belong to fixed images
+    if args.crop_x is not None and args.crop_y is not None:
+        x_train = utils.center_crop(x_train, [args.crop_x, args.crop_y])
+        x_test = utils.center_crop(x_test, [args.crop_x, args.crop_y])
+
+    teacher = create_capsnet(input_shape, n_class=n_class, out_dim=capsnet_out_dim, num_routing=args.num_routing,
+                             dense_decoder=args.dense_decoder)
+    teacher[0].load_weights(args.distill)
+    print("Successfully loaded teacher weights file %s" % args.distill)
+
+    cache = args.distill_cache or args.save_dir + '/teacher_outputs.h5'
+    teacher_outputs = distill.cache_teacher_outputs(teacher[3], 'caps1', dict(train=x_train, test=x_test), cache,
+                                                    label=os.path.abspath(args.distill))
+
+    distill.train(distill.build_distill_model(model, 'caps1'), ((x_train, y_train), (x_test, y_test)), teacher_outputs,
+                  save_dir=args.save_dir,
+                  epochs=args.epochs,
+                  batch_size=args.batch_size,
+                  lr=args.lr,
+                  lr_decay=args.lr_decay,
+                  scale_reconstruction_loss=args.scale_reconstruction_loss,
+                  length_weight=args.distill_length_weight,
+                  pose_weight=args.distill_pose_weight)
+    model.save_weights(args.save_dir + '/student_model.hdf5')
+    print('Student model saved to \'%s/student_model.hdf5\'' % args.save_dir)
+
+    distill.report(teacher[3], fool_model, (x_test, y_test), args.save_dir + '/distill_report.json',
+                   batch_size=args.batch_size)
+
+
+def parallel_compile_args(args):
+    return dict(lr=args.lr,
+                loss=[margin_loss, reconstruction_loss],
+                loss_weights=[1., args.scale_reconstruction_loss],
+                metrics={'capsnet': 'accuracy'})
+
+
 def train(model, data, args):
     # unpacking the data
     (x_train, y_train), (x_test, y_test) = data
 
+    # Every epoch ends with an applied update
+    steps_per_epoch = int(y_train.shape[0] / args.batch_size) // args.accumulate_steps * args.accumulate_steps
+    if steps_per_epoch == 0:
+        raise ValueError("--accumulate_steps %d is larger than the %d batches of an epoch" % (
+                         args.accumulate_steps, int(y_train.shape[0] / args.batch_size)))
+
     # callbacks
-    log = callbacks.CSVLogger(args.save_dir + '/log.csv')
+    log = callbacks.CSVLogger(args.save_dir + '/log.csv', append=args.resume)
     tb = callbacks.TensorBoard(log_dir=args.save_dir + '/tensorboard-logs',
                                batch_size=args.batch_size, histogram_freq=int(args.debug))
-    checkpoint = callbacks.ModelCheckpoint(args.save_dir + '/weights-{epoch:02d}.hdf5', monitor='val_capsnet_acc',
-                                           save_best_only=True, save_weights_only=True, verbose=1)
+    # Written in the background, the last one (with optimizer state) is used by --resume
+    checkpoint = AsyncCheckpoint(args.save_dir + '/checkpoint.hdf5', args.save_dir + '/weights-{epoch:02d}.hdf5',
+                                 monitor='val_capsnet_acc')
     lr_decay = callbacks.LearningRateScheduler(schedule=lambda epoch: args.lr * (args.lr_decay ** epoch))
 
+    # Traces need run options in the train function, so they are passed to compile
+    trace_window, compile_kwargs = None, {}
+    if args.trace_steps is not None:
+        trace_start, trace_end = monitor.parse_step_window(args.trace_steps)
+        trace_window = monitor.TraceWindow(trace_start, trace_end, args.save_dir)
+        compile_kwargs = trace_window.compile_kwargs
+
+    # Accumulate the gradients of several batches to train with a larger effective batch size
+    optimizer = optimizers.Adam(lr=args.lr) if args.accumulate_steps == 1 \
+                else AdamAccumulate(lr=args.lr, accumulate_steps=args.accumulate_steps)
+
     # compile the model
-    model.compile(optimizer=optimizers.Adam(lr=args.lr),
+    model.compile(optimizer=optimizer,
                   loss=[margin_loss, reconstruction_loss],              # We scale down this reconstruction loss by 0.0005 so that
                   loss_weights=[1., args.scale_reconstruction_loss],    # ...it does not dominate the margin loss during training.
-                  metrics={'capsnet': 'accuracy'})                      
+                  metrics={'capsnet': 'accuracy'},
+                  **compile_kwargs)
 
     # Generator with data augmentation as used in [1]
     def train_generator_with_augmentation(x, y, batch_size, shift_fraction=0.):
@@ -184,25 +391,69 @@ def train(model, data, args):
     if args.crop_x is not None and args.crop_y is not None:
         x_test = utils.random_crop(x_test, [args.crop_x, args.crop_y])  
 
-    model.fit_generator(generator=generator,
-                        steps_per_epoch=int(y_train.shape[0] / args.batch_size),
-                        epochs=args.epochs,
-                        validation_data=[[x_test, y_test], [y_test, x_test]],   # Note: For the decoder the input is the label and the output the image
-                        callbacks=[log, tb, checkpoint, lr_decay])
+    # Pick the fastest thread configuration on the first batch
+    if args.autotune_threads:
+        x_batch, y_batch = next(generator)
+        session_config.log_config(session_config.autotune(model, x_batch, y_batch), args.save_dir + "/args.txt")
+
+    # Continue with the weights, optimizer state and lr schedule of the last checkpoint
+    initial_epoch = checkpoint.restore(model) if args.resume else 0
+
+    step_timer = monitor.StepTimer(args.save_dir + '/steps.csv', append=args.resume)
+    callback_list = [log, tb, checkpoint, lr_decay, step_timer]
+    if args.profile_memory:
+        callback_list.append(monitor.MemoryProfiler(args.save_dir + '/memory_report.txt', args.batch_size))
+    if trace_window is not None:
+        callback_list.append(trace_window)
+    # Routing statistics are evaluated on a small fixed batch
+    if args.routing_log_freq > 0:
+        callback_list.append(monitor.RoutingMonitor('caps1', x_test[:16], args.save_dir + '/tensorboard-logs/routing',
+                                                    freq=args.routing_log_freq))
+    # Pruning must be called before the CSVLogger, so the sparsity is logged
+    if args.prune_sparsity > 0:
+        end_step = steps_per_epoch * max(1, args.epochs // 2)
+        callback_list.insert(0, prune.BlockPruning('caps1', args.prune_sparsity, start_step=0, end_step=end_step,
+                                                   granularity=args.prune_granularity,
+                                                   initial_step=initial_epoch * steps_per_epoch))
+
+    if args.workers > 1:
+        # Synchronous data-parallel training. Only log.csv and the best weights are written
+        compile_args = parallel_compile_args(args)
+        build_args = (model.input_shape[0][1:], y_train.shape[1], args.num_routing, args.recompute_routing,
+                      args.dense_decoder, args.capsule_rank, args.conv1_filters, args.primary_channels)
+        trainer = parallel.DataParallelTrainer(parallel.Replica(model, compile_args), build_train_model, build_args,
+                                               compile_args, args.workers)
+        parallel.fit(trainer, generator,
+                     steps_per_epoch=steps_per_epoch,
+                     epochs=args.epochs,
+                     validation_data=([x_test, y_test], [y_test, x_test]),
+                     lr_schedule=lambda epoch: args.lr * (args.lr_decay ** epoch),
+                     save_dir=args.save_dir,
+                     batch_size=args.batch_size)
+    else:
+        model.fit_generator(generator=generator,
+                            steps_per_epoch=steps_per_epoch,
+                            epochs=args.epochs,
+                            validation_data=[[x_test, y_test], [y_test, x_test]],   # Note: For the decoder the input is the label and the output the image
+                            callbacks=callback_list,
+                            initial_epoch=initial_epoch)
 
     model.save_weights(args.save_dir + '/trained_model.hdf5')
     print('Trained model saved to \'%s/trained_model.hdf5\'' % args.save_dir)
 
-    utils.plot_log(args.save_dir + '/log.csv', show=True)
+    writer = utils.ArtifactWriter(args.save_dir, headless=args.headless)
+    utils.plot_log(args.save_dir + '/log.csv', show=not args.headless, writer=writer)
+    writer.close()
 
     return model
 
 
-def test(model, data, args):
+def test(model, recon_model, data, args, writer):
+    """ :param model: Classification-only model used for the metrics
+        :param recon_model: eval_model, only used for the reconstructions of the shown samples
+    """
 
-    # Create an augmentation function and cache augmented samples
-    # to be displayed later
-    x_augmented = []
+    # Create an augmentation function
     def test_generator_with_augmentation(x, batch_size, shift_range, rotation_range):
         test_datagen = ImageDataGenerator(width_shift_range=shift_range,
                                           height_shift_range=shift_range,
@@ -212,40 +463,47 @@ def test(model, data, args):
             x_batch = generator.next()
             if args.crop_x is not None and args.crop_y is not None:
                 x_batch = utils.random_crop(x_batch, [args.crop_x, args.crop_y])    
-            x_augmented.extend(x_batch)
             yield (x_batch)
 
-    # Run predictions
+    # Run predictions batch by batch. Only the metrics and the first samples for the manual
+    # evaluation are kept in memory, misclassified samples are handed to the writer per batch
     test_batch_size = 100
     x_true, y_true = data
+    metrics = utils.StreamingMetrics(n_class=y_true.shape[1])
+    x_shown, x_recon_shown = [], []
     generator = test_generator_with_augmentation(x_true, test_batch_size, args.shift_fraction, args.rotation_range)
-    y_pred, x_recon = model.predict_generator(generator=generator, steps=len(x_true) // test_batch_size)
-
-    # Print different metrics using the top score
-    y_true = np.argmax(y_true, 1)
-    y_pred = np.argmax(y_pred, 1)
-
-    print('Confusion matrix:\n', confusion_matrix(y_true, y_pred))
-    print('\nAccuracy: ', accuracy_score(y_true, y_pred))
-    print('Recall: ', recall_score(y_true, y_pred, average='weighted'))
-    print('Precision: ', precision_score(y_true, y_pred, average='weighted'))
-    print('F1-Score: ', f1_score(y_true, y_pred, average='weighted'))
+    for step in range(len(x_true) // test_batch_size):
+        x_batch = next(generator)
+        y_pred = model.predict_on_batch(x_batch)
+
+        # Update metrics using the top score
+        start = step * test_batch_size
+        y_true_batch = np.argmax(y_true[start:start+len(x_batch)], 1)
+        y_pred_batch = np.argmax(y_pred, 1)
+        metrics.update(y_true_batch, y_pred_batch)
+
+        # The decoder only runs for the samples that are shown
+        num_shown = 100 - len(x_shown)
+        if num_shown > 0:
+            _, x_recon = recon_model.predict_on_batch(x_batch[:num_shown])
+            x_shown.extend(x_batch[:num_shown])
+            x_recon_shown.extend(x_recon)
+
+        # Save invalid images in the background
+        writer.save_misclassified(x_batch, y_true_batch, y_pred_batch, pack=args.pack_misclassified,
+                                  index=start + np.arange(len(x_batch)))
+
+    # Print different metrics
+    metrics.print_report()
 
     # Combine images for manual evaluation
-    stacked_img = utils.stack_images_two_arrays(x_augmented, x_recon, 10, 10)
-    stacked_img = stacked_img.resize((700, 700), Image.ANTIALIAS)
-    stacked_img.show()
-    stacked_img.save(args.save_dir + "/real_and_recon.png")
-
-    # Display invalid and correct images
-    for i in range(len(x_true)):
-        if(y_true[i] == y_pred[i]):
-            continue
-        invalid_prediction = x_augmented[i]*255
-        Image.fromarray(invalid_prediction.astype(np.uint8)).save(args.save_dir + "/wrongly_classified_%d.png" % i)
+    stacked_img = utils.stack_images_two_arrays(x_shown, x_recon_shown, 10, 10)
+    stacked_img = stacked_img.resize((700, 700 * stacked_img.height // stacked_img.width), Image.ANTIALIAS)
+    writer.show(stacked_img)
+    writer.save_image(stacked_img, "real_and_recon.png")
 
 
-def manipulate_latent(model, n_class, out_dim, data, args):
+def manipulate_latent(model, n_class, out_dim, data, args, writer):
     x_true, y_true = data
 
     index = np.argmax(y_true, 1) == args.manipulate
@@ -270,8 +528,8 @@ def manipulate_latent(model, n_class, out_dim, data, args):
             r += 0.05
     
     img = utils.stack_images(x_recons, out_dim)
-    img.show()
-    img.save(args.save_dir + "/manipulate-%d.png" % args.manipulate)
+    writer.show(img)
+    writer.save_image(img, "manipulate-%d.png" % args.manipulate)
 
 
 def adversarial_attack(fool_model, x_test, y_test, max_num_attacks=500, epsilon=0.01, debug=False):
@@ -340,6 +598,9 @@ if __name__ == "__main__":
 
     parser.add_argument('--batch_size', default=64, type=int)
 
+    parser.add_argument('--accumulate_steps', default=1, type=int,
+                        help="Number of batches whose gradients are summed before one Adam update. The effective batch size is batch_size * accumulate_steps")
+
     parser.add_argument('--max_num_samples', default=None, type=int,
                         help="Max. number of training examples to use. -1 to use all")
 
@@ -355,6 +616,24 @@ if __name__ == "__main__":
     parser.add_argument('-r', '--num_routing', default=3, type=int,
                         help="Number of iterations used in routing algorithm. should > 0")
 
+    parser.add_argument('--dense_decoder', action='store_true',
+                        help="Use the flattened Mask and a Dense first decoder layer instead of the class conditional one. Both share the same weights")
+
+    parser.add_argument('--recompute_routing', action='store_true',
+                        help="Recompute the routing iterations in the backward pass instead of storing them. Saves memory for larger num_routing")
+
+    parser.add_argument('--capsule_rank', default=None, type=int,
+                        help="Use low-rank transformation matrices W_ij = U_j V_ij of this rank in caps1. Does not support --recompute_routing")
+
+    parser.add_argument('--factorize', action='store_true',
+                        help="Factorize caps1 of the dense weights given via -w by SVD to --capsule_rank and save them into save_dir/factorized_model.hdf5")
+
+    parser.add_argument('--conv1_filters', default=256, type=int,
+                        help="Number of filters of conv1. Use smaller values for a distilled student")
+
+    parser.add_argument('--primary_channels', default=64, type=int,
+                        help="Number of primary capsule channels. Use smaller values for a distilled student")
+
     parser.add_argument('--shift_fraction', default=0.1, type=float,
                         help="Fraction of pixels to shift at most in each direction.")
 
@@ -367,8 +646,41 @@ if __name__ == "__main__":
     parser.add_argument('--debug', action='store_true',
                         help="Save weights by TensorBoard")
 
+    parser.add_argument('--profile_memory', action='store_true',
+                        help="Write the largest tensors and the peak RSS of every epoch into save_dir/memory_report.txt")
+
+    parser.add_argument('--trace_steps', default=None,
+                        help="Capture a TF timeline of the training steps START:END (END excluded) into save_dir")
+
+    parser.add_argument('--routing_log_freq', default=0, type=int,
+                        help="Log routing statistics to TensorBoard every N training steps. 0 disables it.")
+
+    parser.add_argument('--workers', default=1, type=int,
+                        help="Number of processes for synchronous data-parallel training. Every batch is split across the workers.")
+
+    parser.add_argument('--scaling_study', action='store_true',
+                        help="Measure the training throughput and scaling efficiency from 1 to --workers workers into save_dir/scaling.json")
+
+    parser.add_argument('--intra_op_threads', default=0, type=int,
+                        help="Threads used inside of one op. 0 uses one thread per available core. Without any of these flags TF keeps its defaults")
+
+    parser.add_argument('--inter_op_threads', default=0, type=int,
+                        help="Number of ops run in parallel. 0 uses the TF default")
+
+    parser.add_argument('--cpus', default=None,
+                        help="Pin the process to these cores, e.g. 0-7,16-23. Use it to run several jobs on one host")
+
+    parser.add_argument('--numa_node', default=None, type=int,
+                        help="Pin the process to the cores (and thereby the memory) of this NUMA node")
+
+    parser.add_argument('--autotune_threads', action='store_true',
+                        help="Time a few training steps for a small grid of thread settings and train with the fastest")
+
     parser.add_argument('--save_dir', default='./result-capsnet')
 
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue the training from save_dir/checkpoint.hdf5 (weights, optimizer state and epoch)")
+
     parser.add_argument('-t', '--testing', action='store_true',
                         help="Test the trained model on testing dataset")
     
@@ -381,8 +693,74 @@ if __name__ == "__main__":
     parser.add_argument('--manipulate', default=5, type=int,
                         help="Vector to manipulate")
 
+    parser.add_argument('--headless', action='store_true',
+                        help="Do not show any image or plot. Plots are saved into save_dir instead.")
+
+    parser.add_argument('--pack_misclassified', default='png', choices=['png', 'npz', 'sprite'],
+                        help="(TestOnly) Save misclassified samples as single pngs, as one compressed npz or as one sprite sheet.")
+
+    parser.add_argument('--export_routing', default=None,
+                        help="Export the coupling coefficients c_ij and b_ij of the whole split into the given HDF5 file. So provide weights via -w.")
+
+    parser.add_argument('--export_split', default='test', choices=['test', 'train'],
+                        help="Split used by --export_routing")
+
+    parser.add_argument('--distill', default=None,
+                        help="Weights of a full size teacher. Train the model given by --conv1_filters and --primary_channels on its capsule lengths and poses and report speedup and accuracy retention")
+
+    parser.add_argument('--distill_cache', default=None,
+                        help="HDF5 file for the cached teacher outputs. Default is save_dir/teacher_outputs.h5")
+
+    parser.add_argument('--distill_length_weight', default=1., type=float,
+                        help="Weight of the mean squared error to the capsule lengths of the teacher")
+
+    parser.add_argument('--distill_pose_weight', default=1., type=float,
+                        help="Weight of the mean squared error to the pose vectors of the teacher")
+
+    parser.add_argument('--freeze', default=None,
+                        help="Write the inference graph (eval_model) with folded weights into the given file. Run it with freeze.FrozenModel. So provide weights via -w.")
+
+    parser.add_argument('--quantize', default=None,
+                        help="Compress conv kernels and W of the classification model to int8, save them into the given npz file and compare accuracy and size with float32. The weights are dequantized at load time, inference is not faster. So provide weights via -w.")
+
+    parser.add_argument('--calibration_samples', default=300, type=int,
+                        help="Number of training images used to calibrate --quantize")
+
+    parser.add_argument('--prune_sparsity', default=0., type=float,
+                        help="Fine-tune while pruning this fraction of the W_ij blocks of caps1. The sparsity is reached after half of the epochs")
+
+    parser.add_argument('--prune_granularity', default='block', choices=['block', 'input'],
+                        help="Prune single blocks W_ij or all blocks of an input capsule. Only input capsules without blocks are dropped at inference (-t and --prune_report)")
+
+    parser.add_argument('--prune_report', default=None,
+                        help="Append accuracy and latency of the sparse model for several sparsities to the given csv file. So provide weights via -w.")
+
     parser.add_argument('-w', '--weights', default=None,
-                        help="The path of the saved weights. Should be specified when testing")
+                        help="The path of the saved weights (HDF5 or .mmw). Should be specified when testing")
     args = parser.parse_args()
+    if args.trace_steps is not None:
+        try:
+            monitor.parse_step_window(args.trace_steps)
+        except ValueError as e:
+            parser.error("--trace_steps: %s" % e)
+    if args.accumulate_steps < 1:
+        parser.error("--accumulate_steps must be at least 1")
+    if args.workers > 1 and args.accumulate_steps > 1:
+        parser.error("--accumulate_steps is not supported with --workers > 1")
+    if args.workers > 1 and args.resume:
+        parser.error("--resume is not supported with --workers > 1")
+    # The data-parallel training loop runs no keras callbacks
+    if args.workers > 1 and (args.trace_steps is not None or args.routing_log_freq > 0 or args.profile_memory or
+                             args.prune_sparsity > 0 or args.autotune_threads):
+        parser.error("--trace_steps, --routing_log_freq, --profile_memory, --prune_sparsity and --autotune_threads "
+                     "are not supported with --workers > 1")
+    if args.factorize and (args.capsule_rank is None or args.weights is None):
+        parser.error("--factorize needs --capsule_rank and the dense weights via -w")
+    if args.capsule_rank is not None and not 0 < args.capsule_rank <= capsnet_out_dim:
+        parser.error("--capsule_rank must be in [1, %d]" % capsnet_out_dim)
+    if args.capsule_rank is not None and args.recompute_routing:
+        parser.error("--recompute_routing is not supported with --capsule_rank")
+    if args.capsule_rank is not None and (args.prune_sparsity > 0 or args.prune_report is not None):
+        parser.error("Pruning needs the dense W of caps1 and is not supported with --capsule_rank")
 
     main(args)
\ No newline at end of file
@@ -5,6 +5,11 @@ import numpy as np
 from PIL import Image
 import matplotlib.pyplot as plt
 
+# OpenMP and MKL read their thread settings when TF is loaded, so the process is pinned before keras is imported
+import pinning
+if __name__ == "__main__":
+    pinning.pin_from_argv(sys.argv[1:])
+
 import keras
 from keras import callbacks, layers, models, optimizers
 from keras import backend as K
@@ -13,13 +18,13 @@ from keras.datasets import cifar10
 from keras.preprocessing.image import ImageDataGenerator
 from keras.losses import categorical_crossentropy
 
-from sklearn.metrics import confusion_matrix, f1_score, accuracy_score, recall_score, precision_score
-
 import foolbox
 from foolbox.attacks import LBFGSAttack
 from foolbox.criteria import TargetClassProbability
 
 import utils
+import monitor
+import session_config
 
 
 #
@@ -43,6 +48,12 @@ def main(args):
             sorted_args = sorted(vars(args).items())
             out.write('\n'.join("{0} = {1}".format(a, v) for (a, v) in sorted_args))
 
+    # Configure threads and pinning before the first session is created, otherwise TF keeps its defaults
+    if args.intra_op_threads or args.inter_op_threads or args.cpus is not None or args.numa_node is not None:
+        session = session_config.configure_session(args.intra_op_threads, args.inter_op_threads, args.cpus, args.numa_node)
+        if not args.testing:
+            session_config.log_config(session, args.save_dir + "/args.txt")
+
     # Set learning phase for tf
     if args.testing or args.fool:
         keras.backend.set_learning_phase(0)
@@ -135,10 +146,25 @@ def train(model, data, args):
                                            save_best_only=True, save_weights_only=True, verbose=1)
     lr_decay = callbacks.LearningRateScheduler(schedule=lambda epoch: args.lr * (args.lr_decay ** epoch))
 
+    # Traces need run options in the train function, so they are passed to compile
+    trace_window, compile_kwargs = None, {}
+    if args.trace_steps is not None:
+        trace_start, trace_end = monitor.parse_step_window(args.trace_steps)
+        trace_window = monitor.TraceWindow(trace_start, trace_end, args.save_dir)
+        compile_kwargs = trace_window.compile_kwargs
+
+    step_timer = monitor.StepTimer(args.save_dir + '/steps.csv')
+    callback_list = [log, tb, checkpoint, lr_decay, step_timer]
+    if args.profile_memory:
+        callback_list.append(monitor.MemoryProfiler(args.save_dir + '/memory_report.txt', args.batch_size))
+    if trace_window is not None:
+        callback_list.append(trace_window)
+
     # compile the model
     model.compile(optimizer=optimizers.Adam(lr=args.lr),
                   loss=categorical_crossentropy,
-                  metrics=['accuracy'])      
+                  metrics=['accuracy'],
+                  **compile_kwargs)
 
     # Generator with data augmentation as used in [1] ([...] also trained on 2-pixel shifted MNIST)
     def train_generator_with_augmentation(x, y, batch_size, shift_fraction=0.):
@@ -153,11 +179,17 @@ def train(model, data, args):
 
     
     generator = train_generator_with_augmentation(x_train, y_train, args.batch_size, args.shift_fraction)
+
+    # Pick the fastest thread configuration on the first batch
+    if args.autotune_threads:
+        x_batch, y_batch = next(generator)
+        session_config.log_config(session_config.autotune(model, x_batch, y_batch), args.save_dir + "/args.txt")
+
     model.fit_generator(generator=generator,
                         steps_per_epoch=int(y_train.shape[0] / args.batch_size),
                         epochs=args.epochs,
                         validation_data=[x_test, y_test],
-                        callbacks=[log, tb, checkpoint, lr_decay])
+                        callbacks=callback_list)
 
     model.save_weights(args.save_dir + '/trained_model.hdf5')
     print('Trained model saved to \'%s/trained_model.hdf5\'' % args.save_dir)
@@ -169,8 +201,7 @@ def train(model, data, args):
 
 def test(model, data, args):
 
-    # Create an augmentation function and cache augmented samples
-    # to be displayed later
+    # Create an augmentation function
     def test_generator_with_augmentation(x, batch_size, shift_range, rotation_range):
         test_datagen = ImageDataGenerator(width_shift_range=shift_range,
                                           height_shift_range=shift_range,
@@ -183,21 +214,20 @@ def test(model, data, args):
             yield (x_batch)
 
 
-    # Run predictions
+    # Run predictions batch by batch and accumulate the metrics using the top score
     test_batch_size = 100
     x_true, y_true = data
+    metrics = utils.StreamingMetrics(n_class=y_true.shape[1])
     generator = test_generator_with_augmentation(x_true, test_batch_size, args.shift_fraction, args.rotation_range)
-    y_pred = model.predict_generator(generator=generator, steps=len(x_true) // test_batch_size)
+    for step in range(len(x_true) // test_batch_size):
+        x_batch = next(generator)
+        y_pred = model.predict_on_batch(x_batch)
 
-    # Print different metrics using the top score
-    y_true = np.argmax(y_true, 1)
-    y_pred = np.argmax(y_pred, 1)
+        start = step * test_batch_size
+        metrics.update(np.argmax(y_true[start:start+len(x_batch)], 1), np.argmax(y_pred, 1))
 
-    print('Confusion matrix:\n', confusion_matrix(y_true, y_pred))
-    print('\nAccuracy: ', accuracy_score(y_true, y_pred))
-    print('Recall: ', recall_score(y_true, y_pred, average='weighted'))
-    print('Precision: ', precision_score(y_true, y_pred, average='weighted'))
-    print('F1-Score: ', f1_score(y_true, y_pred, average='weighted'))
+    # Print different metrics
+    metrics.print_report()
 
     
 def adversarial_attack(fool_model, x_test, y_test, max_num_attacks=500, epsilon=0.01, debug=False):
@@ -288,9 +318,30 @@ if __name__ == "__main__":
     parser.add_argument('--debug', action='store_true',
                         help="Save weights by TensorBoard")
 
+    parser.add_argument('--profile_memory', action='store_true',
+                        help="Write the largest tensors and the peak RSS of every epoch into save_dir/memory_report.txt")
+
+    parser.add_argument('--trace_steps', default=None,
+                        help="Capture a TF timeline of the training steps START:END (END excluded) into save_dir")
+
     parser.add_argument('-f', '--fool', action='store_true',
                         help="Run adversarial attacks on the trained model. So provide weights via -w.")
 
+    parser.add_argument('--intra_op_threads', default=0, type=int,
+                        help="Threads used inside of one op. 0 uses one thread per available core. Without any of these flags TF keeps its defaults")
+
+    parser.add_argument('--inter_op_threads', default=0, type=int,
+                        help="Number of ops run in parallel. 0 uses the TF default")
+
+    parser.add_argument('--cpus', default=None,
+                        help="Pin the process to these cores, e.g. 0-7,16-23. Use it to run several jobs on one host")
+
+    parser.add_argument('--numa_node', default=None, type=int,
+                        help="Pin the process to the cores (and thereby the memory) of this NUMA node")
+
+    parser.add_argument('--autotune_threads', action='store_true',
+                        help="Time a few training steps for a small grid of thread settings and train with the fastest")
+
     parser.add_argument('--save_dir', default='./result-convnet')
 
     parser.add_argument('-t', '--testing', action='store_true',
@@ -299,5 +350,10 @@ if __name__ == "__main__":
     parser.add_argument('-w', '--weights', default=None,
                         help="The path of the saved weights. Should be specified when testing")
     args = parser.parse_args()
+    if args.trace_steps is not None:
+        try:
+            monitor.parse_step_window(args.trace_steps)
+        except ValueError as e:
+            parser.error("--trace_steps: %s" % e)
 
     main(args)
\ No newline at end of file
@@ -0,0 +1,122 @@
+import os
+import json
+import h5py
+import numpy as np
+
+from keras import callbacks, layers, models, optimizers
+
+import utils
+from capsule import margin_loss, reconstruction_loss
+
+
+def cache_teacher_outputs(teacher, layer_name, splits, path, label='', batch_size=100):
+    """ Compute the capsule lengths and pose vectors of the teacher once and store them in an HDF5
+        file with one group per split. An existing cache is reused if it was written for the same
+        label (e.g. the teacher weights file) and the same number of samples.
+
+        :param teacher: Classification model of the teacher, i.e. up to Length
+        :param layer_name: Name of the CapsuleLayer of the teacher
+        :param splits: Dict split name -> images, e.g. dict(train=x_train, test=x_test)
+        :param path: HDF5 file
+        :return Dict split name -> (lengths, poses), both loaded into memory
+    """
+    if _is_valid_cache(path, splits, label):
+        print("Using cached teacher outputs from %s" % path)
+    else:
+        extractor = models.Model(teacher.inputs, [teacher.outputs[0], teacher.get_layer(layer_name).output])
+        _, n_class, dim_vector = extractor.output_shape[1]
+
+        # Written into a temporary file, so an interrupted run never leaves a valid looking cache
+        with h5py.File(path + '.tmp', 'w') as f:
+            f.attrs['label'] = label
+            for split, x in splits.items():
+                group = f.create_group(split)
+                lengths = group.create_dataset('lengths', (len(x), n_class), dtype='float32')
+                poses = group.create_dataset('poses', (len(x), n_class, dim_vector), dtype='float32')
+                for start in range(0, len(x), batch_size):
+                    lengths_batch, poses_batch = extractor.predict_on_batch(x[start:start+batch_size])
+                    lengths[start:start+len(lengths_batch)] = lengths_batch
+                    poses[start:start+len(poses_batch)] = poses_batch
+        os.replace(path + '.tmp', path)
+        print("Teacher outputs saved to %s" % path)
+
+    with h5py.File(path, 'r') as f:
+        return {split: (f[split]['lengths'][:], f[split]['poses'][:]) for split in splits}
+
+
+def _is_valid_cache(path, splits, label):
+    if not os.path.exists(path):
+        return False
+    with h5py.File(path, 'r') as f:
+        return f.attrs.get('label') == label and \
+               all(split in f and len(f[split]['lengths']) == len(x) for split, x in splits.items())
+
+
+def build_distill_model(train_model, layer_name):
+    """ Add the capsule lengths and the pose vectors of the student as two more outputs to its
+        training model. Both are identities, so the student keeps its weights and its weights file
+        can be loaded by the training model again.
+    """
+    lengths = layers.Lambda(lambda t: t, name='distill_lengths')(train_model.outputs[0])
+    poses = layers.Lambda(lambda t: t, name='distill_poses')(train_model.get_layer(layer_name).output)
+    return models.Model(train_model.inputs, train_model.outputs + [lengths, poses])
+
+
+def train(model, data, teacher_outputs, save_dir, epochs, batch_size, lr, lr_decay,
+          scale_reconstruction_loss, length_weight=1., pose_weight=1.):
+    """ Train a student with the margin and reconstruction loss on the labels plus the mean squared
+        error to the cached capsule lengths and pose vectors of the teacher. The images are not
+        augmented, because the teacher outputs are computed for the unchanged images.
+
+        :param model: Model created by build_distill_model
+        :param data: ((x_train, y_train), (x_test, y_test))
+        :param teacher_outputs: Dict with (lengths, poses) of the splits 'train' and 'test'
+    """
+    (x_train, y_train), (x_test, y_test) = data
+    (lengths_train, poses_train), (lengths_test, poses_test) = teacher_outputs['train'], teacher_outputs['test']
+
+    model.compile(optimizer=optimizers.Adam(lr=lr),
+                  loss=[margin_loss, reconstruction_loss, 'mse', 'mse'],
+                  loss_weights=[1., scale_reconstruction_loss, length_weight, pose_weight],
+                  metrics={'capsnet': 'accuracy'})
+
+    log = callbacks.CSVLogger(save_dir + '/distill_log.csv')
+    checkpoint = callbacks.ModelCheckpoint(save_dir + '/student-weights-{epoch:02d}.hdf5', monitor='val_capsnet_acc',
+                                           save_best_only=True, save_weights_only=True, verbose=1)
+    lr_schedule = callbacks.LearningRateScheduler(schedule=lambda epoch: lr * (lr_decay ** epoch))
+
+    model.fit([x_train, y_train], [y_train, x_train, lengths_train, poses_train],
+              batch_size=batch_size,
+              epochs=epochs,
+              validation_data=[[x_test, y_test], [y_test, x_test, lengths_test, poses_test]],
+              callbacks=[log, checkpoint, lr_schedule])
+    return model
+
+
+def report(teacher, student, data, path=None, batch_size=100, repeats=20):
+    """ Compare accuracy, latency and size of the teacher and the student classification models.
+
+        :param data: (x_test, y_test)
+        :param path: Optional JSON file for the report
+    """
+    x_test, y_test = data
+    result = {}
+    for name, model in [('teacher', teacher), ('student', student)]:
+        result[name + '_accuracy'] = utils.accuracy(model, x_test, y_test, batch_size)
+        result[name + '_ms_per_batch'] = utils.latency_ms(model, x_test[:batch_size], repeats)
+        result[name + '_params'] = int(model.count_params())
+
+    result.update(batch_size=batch_size,
+                  speedup=result['teacher_ms_per_batch'] / result['student_ms_per_batch'],
+                  accuracy_retention=result['student_accuracy'] / result['teacher_accuracy'])
+
+    print("\n%-10s %10s %14s %12s" % ("", "accuracy", "ms per batch", "params"))
+    for name in ['teacher', 'student']:
+        print("%-10s %10.4f %14.2f %12d" % (name, result[name + '_accuracy'], result[name + '_ms_per_batch'],
+                                           result[name + '_params']))
+    print("Speedup %.2fx with %.1f%% of the teacher accuracy" % (result['speedup'], 100. * result['accuracy_retention']))
+
+    if path is not None:
+        with open(path, 'w') as out:
+            json.dump(result, out, indent=2)
+    return result
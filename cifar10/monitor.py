@@ -0,0 +1,342 @@
+import os
+import csv
+import time
+import resource
+import numpy as np
+import tensorflow as tf
+
+from keras import callbacks
+from keras import backend as K
+
+
+class RoutingMonitor(callbacks.Callback):
+    """ Log routing statistics of a CapsuleLayer as TensorBoard scalars. Every freq training steps
+        the routing is evaluated on a small fixed batch and we log per iteration
+            - the time of the iteration
+            - the mean entropy of c_ij over the output capsules
+            - the mean absolute change of c_ij compared to the previous iteration
+            - the mean length of v_j
+        and the distribution (min, percentiles, max) of the final lengths of v_j.
+
+        :param layer_name: Name of the CapsuleLayer
+        :param x: Fixed batch of input images, e.g. 16 test images
+        :param log_dir: Directory of the TensorBoard event files
+        :param freq: Log every freq steps
+    """
+    def __init__(self, layer_name, x, log_dir, freq=100):
+        super(RoutingMonitor, self).__init__()
+        self.layer_name = layer_name
+        self.x = x
+        self.log_dir = log_dir
+        self.freq = freq
+        self.step = 0
+
+    def on_train_begin(self, logs=None):
+        layer = self.model.get_layer(self.layer_name)
+        x_input = self.model.inputs[0]
+
+        # Rebuild the routing on the input of the layer, so that every iteration can be fetched.
+        # The weights are shared with the trained layer
+        with tf.name_scope('routing_monitor'):
+            u_hat = layer.predict_vectors(layer.input)
+            trace = []
+            layer.route(u_hat, trace=trace)
+
+        self.trace_fn = K.function([x_input], [t for iteration in trace for t in iteration])
+
+        # One function per iteration to measure the time of each single iteration
+        self.timing_fns = [K.function([x_input], [u_hat])]
+        self.timing_fns += [K.function([x_input], [v_j]) for _, v_j in trace]
+        self.writer = tf.summary.FileWriter(self.log_dir)
+
+    def on_batch_end(self, batch, logs=None):
+        self.step += 1
+        if self.step % self.freq != 0:
+            return
+
+        values = {}
+
+        # Time of the prediction vectors and of every iteration. Each fetch
+        # includes all previous iterations, so we log the difference
+        times = [self._time(fn) for fn in self.timing_fns]
+        values['routing/u_hat_ms'] = times[0]
+        for i in range(1, len(times)):
+            values['routing/iteration_%d/time_ms' % (i-1)] = max(times[i] - times[i-1], 0.)
+
+        outputs = self.trace_fn([self.x])
+        c_prev = None
+        for i in range(len(outputs) // 2):
+            c_ij, v_j = outputs[2*i], outputs[2*i+1]
+            entropy = -np.sum(c_ij * np.log(c_ij + K.epsilon()), axis=1)
+            values['routing/iteration_%d/c_ij_entropy' % i] = float(np.mean(entropy))
+            values['routing/iteration_%d/v_j_length' % i] = float(np.mean(np.linalg.norm(v_j, axis=-1)))
+            if c_prev is not None:
+                values['routing/iteration_%d/c_ij_change' % i] = float(np.mean(np.abs(c_ij - c_prev)))
+            c_prev = c_ij
+
+        lengths = np.linalg.norm(outputs[-1], axis=-1)
+        values['routing/v_j_length/min'] = float(np.min(lengths))
+        values['routing/v_j_length/max'] = float(np.max(lengths))
+        for p in [5, 50, 95]:
+            values['routing/v_j_length/p%d' % p] = float(np.percentile(lengths, p))
+
+        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value) for tag, value in sorted(values.items())])
+        self.writer.add_summary(summary, self.step)
+        self.writer.flush()
+
+    def on_train_end(self, logs=None):
+        self.writer.close()
+
+    def _time(self, fn, repeats=3):
+        fn([self.x])    # warm up
+        start = time.time()
+        for _ in range(repeats):
+            fn([self.x])
+        return (time.time() - start) / repeats * 1000
+
+
+class StepTimer(callbacks.Callback):
+    """ Record per epoch the throughput, the mean and tail step time and how much of
+        every step is spent waiting on the generator compared to compute. The time between the
+        end of a batch and the begin of the next one is spent in the generator.
+        Results are written into a csv file and a summary is printed at the end of the training.
+
+        :param filename: Path of the csv file, e.g. save_dir/steps.csv
+        :param append: Append to an existing file, e.g. when the training is resumed
+    """
+    fields = ['epoch', 'samples_per_sec', 'step_ms_mean', 'step_ms_p50', 'step_ms_p95', 'step_ms_p99',
+              'step_ms_max', 'wait_ms_total', 'compute_ms_total', 'wait_fraction', 'epoch_sec']
+
+    def __init__(self, filename, append=False):
+        super(StepTimer, self).__init__()
+        self.filename = filename
+        self.append = append
+
+    def on_train_begin(self, logs=None):
+        self.rows = []
+        write_header = not (self.append and os.path.exists(self.filename) and os.path.getsize(self.filename) > 0)
+        self.file = open(self.filename, 'a' if self.append else 'w')
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fields)
+        if write_header:
+            self.writer.writeheader()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.time()
+        self.batch_end = self.epoch_start
+        self.wait, self.compute = [], []
+        self.samples = 0
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_start = time.time()
+        self.wait.append(self.batch_start - self.batch_end)
+
+    def on_batch_end(self, batch, logs=None):
+        self.batch_end = time.time()
+        self.compute.append(self.batch_end - self.batch_start)
+        self.samples += (logs or {}).get('size', 0)
+
+    def on_epoch_end(self, epoch, logs=None):
+        wait, compute = np.array(self.wait) * 1000, np.array(self.compute) * 1000
+        steps = wait + compute
+        row = dict(epoch=epoch,
+                   samples_per_sec=self.samples / max(steps.sum() / 1000, K.epsilon()),
+                   step_ms_mean=steps.mean(),
+                   step_ms_p50=np.percentile(steps, 50),
+                   step_ms_p95=np.percentile(steps, 95),
+                   step_ms_p99=np.percentile(steps, 99),
+                   step_ms_max=steps.max(),
+                   wait_ms_total=wait.sum(),
+                   compute_ms_total=compute.sum(),
+                   wait_fraction=wait.sum() / max(steps.sum(), K.epsilon()),
+                   epoch_sec=time.time() - self.epoch_start)
+        self.rows.append(row)
+        self.writer.writerow(row)
+        self.file.flush()
+
+    def on_train_end(self, logs=None):
+        self.file.close()
+
+        print("\n" + "=" * 40 + " STEPS " + "=" * 40)
+        print("%5s %12s %10s %10s %10s %10s %12s" % ("epoch", "samples/sec", "mean [ms]", "p95 [ms]",
+                                                    "p99 [ms]", "wait [%]", "epoch [sec]"))
+        for row in self.rows:
+            print("%5d %12.1f %10.1f %10.1f %10.1f %10.1f %12.1f" % (row['epoch'], row['samples_per_sec'],
+                  row['step_ms_mean'], row['step_ms_p95'], row['step_ms_p99'], row['wait_fraction'] * 100, row['epoch_sec']))
+        print("Step times saved to %s" % self.filename)
+
+
+class MemoryProfiler(callbacks.Callback):
+    """ Write a memory report with the largest tensors of the graph and the peak RSS of every epoch.
+        The tensor sizes are static sizes where the batch dimension is set to batch_size. The report is
+        written before the first step and extended after every epoch, so it is also useful after an OOM.
+
+        :param filename: Path of the report, e.g. save_dir/memory_report.txt
+        :param batch_size: Batch size used for unknown dimensions
+        :param num_tensors: Number of tensors listed in the report
+    """
+    def __init__(self, filename, batch_size, num_tensors=30):
+        super(MemoryProfiler, self).__init__()
+        self.filename = filename
+        self.batch_size = batch_size
+        self.num_tensors = num_tensors
+
+    def on_train_begin(self, logs=None):
+        tensors = largest_tensors(K.get_session().graph, self.batch_size, self.num_tensors)
+        with open(self.filename, 'w') as out:
+            out.write("Largest tensors for batch_size = %d\n" % self.batch_size)
+            out.write("%10s  %-24s %s\n" % ("MB", "shape", "tensor"))
+            for size, shape, name in tensors:
+                out.write("%10.1f  %-24s %s\n" % (size / 2.**20, shape, name))
+            out.write("\nPeak RSS per epoch\n")
+
+    def on_epoch_begin(self, epoch, logs=None):
+        _reset_peak_rss()
+
+    def on_epoch_end(self, epoch, logs=None):
+        peak = _peak_rss_mb()
+        print("Peak RSS of epoch %d: %.1f MB" % (epoch, peak))
+        with open(self.filename, 'a') as out:
+            out.write("epoch %d: %.1f MB\n" % (epoch, peak))
+
+
+def largest_tensors(graph, batch_size, num_tensors=30):
+    """ Return the num_tensors largest tensors of the graph as list of (bytes, shape, name).
+        Unknown dimensions (the batch dimension) are set to batch_size.
+    """
+    tensors = []
+    for op in graph.get_operations():
+        for t in op.outputs:
+            if t.shape.ndims is None:
+                continue
+
+            try:
+                dtype_size = t.dtype.size
+            except (TypeError, ValueError):    # resource and string tensors
+                continue
+
+            shape = [batch_size if d is None else d for d in t.shape.as_list()]
+            tensors.append((int(np.prod(shape)) * dtype_size, str(tuple(shape)), t.name))
+
+    return sorted(tensors, reverse=True)[:num_tensors]
+
+
+def _reset_peak_rss():
+    # Linux only: Writing 5 to clear_refs resets the peak RSS (VmHWM) of the process
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+
+    # Peak over the lifetime of the process (kB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class TraceWindow(callbacks.Callback):
+    """ Capture a TensorFlow timeline of the training steps start <= step < end (counted over all epochs).
+        For every step a chrome trace save_dir/trace_step_<step>.json is written (open it via chrome://tracing)
+        and trace_summary.txt sums the op times of the window per scope (conv1, primary_caps,
+        every routing iteration, decoder and their gradients).
+
+        The train function must be compiled with the run options of this callback,
+        i.e. model.compile(..., **trace_window.compile_kwargs)
+
+        :param start: First traced step
+        :param end: First step that is not traced anymore
+        :param save_dir: Directory of the traces
+    """
+    def __init__(self, start, end, save_dir):
+        super(TraceWindow, self).__init__()
+        if not 0 <= start < end:
+            raise ValueError("The trace window needs 0 <= start < end, got %d:%d" % (start, end))
+        self.start = start
+        self.end = end
+        self.save_dir = save_dir
+        self.step = 0
+        self.op_times = {}
+        self.run_options = tf.RunOptions(trace_level=tf.RunOptions.NO_TRACE)
+        self.run_metadata = tf.RunMetadata()
+
+    @property
+    def compile_kwargs(self):
+        return dict(options=self.run_options, run_metadata=self.run_metadata)
+
+    def on_batch_begin(self, batch, logs=None):
+        if self.step == self.start:
+            self._set_trace_level(tf.RunOptions.FULL_TRACE)
+
+    def on_batch_end(self, batch, logs=None):
+        if self.start <= self.step < self.end:
+            self._save_trace()
+        self.step += 1
+
+        if self.step == self.end:
+            self._set_trace_level(tf.RunOptions.NO_TRACE)
+            self._save_summary()
+
+    def _set_trace_level(self, trace_level):
+        self.run_options.trace_level = trace_level
+
+        # Newer versions of keras create a callable with a copy of the run options,
+        # so we force keras to create a new one with the current options
+        train_function = self.model.train_function
+        if train_function is not None and hasattr(train_function, '_callable_fn'):
+            train_function._callable_fn = None
+
+    def _save_trace(self):
+        from tensorflow.python.client import timeline
+        trace = timeline.Timeline(self.run_metadata.step_stats)
+        with open(os.path.join(self.save_dir, 'trace_step_%d.json' % self.step), 'w') as out:
+            out.write(trace.generate_chrome_trace_format())
+
+        for device in self.run_metadata.step_stats.dev_stats:
+            for node in device.node_stats:
+                scope = _op_scope(node.node_name)
+                self.op_times[scope] = self.op_times.get(scope, 0) + node.all_end_rel_micros / 1000.
+
+    def _save_summary(self):
+        filename = os.path.join(self.save_dir, 'trace_summary.txt')
+        with open(filename, 'w') as out:
+            out.write("Op time in ms of steps %d to %d per scope\n" % (self.start, self.end - 1))
+            for scope, ms in sorted(self.op_times.items(), key=lambda s: -s[1]):
+                out.write("%12.2f  %s\n" % (ms, scope))
+        print("\nTrace of steps %d to %d saved to %s" % (self.start, self.end - 1, self.save_dir))
+
+
+def parse_step_window(value):
+    """ "START:END" -> (start, end) with 0 <= start < end, e.g. of --trace_steps
+    """
+    try:
+        start, end = [int(s) for s in value.split(':')]
+    except ValueError:
+        raise ValueError("expected START:END, got '%s'" % value)
+    if not 0 <= start < end:
+        raise ValueError("expected 0 <= START < END, got '%s'" % value)
+    return start, end
+
+
+def _op_scope(node_name):
+    """ Map an op name to the layer it belongs to, e.g.
+            conv1/convolution                                     -> conv1
+            caps1/routing_1/Softmax                               -> caps1/routing_1
+            training/Adam/gradients/caps1/routing_1/Softmax_grad  -> gradients/caps1/routing_1
+    """
+    parts = node_name.split('/')
+    prefix = ''
+    if 'gradients' in parts:
+        parts = parts[parts.index('gradients') + 1:]
+        prefix = 'gradients/'
+
+    if len(parts) > 2 and parts[1].startswith(('routing_', 'u_hat', 'u_tiled', 'W_tiled')):
+        return prefix + '/'.join(parts[:2])
+    return prefix + parts[0]
@@ -0,0 +1,295 @@
+import os
+import sys
+import csv
+import time
+import json
+import tempfile
+import multiprocessing
+import numpy as np
+
+from keras import optimizers
+from keras import backend as K
+
+import session_config
+
+
+class Replica(object):
+    """ One copy of the training model with a function that computes the gradients of a batch
+        and a function that applies (averaged) gradients with Adam. All replicas start with the
+        same weights and apply the same averaged gradients, so they stay in sync.
+
+        :param model: Uncompiled Keras training model
+        :param compile_kwargs: dict(lr=..., loss=..., loss_weights=..., metrics=...)
+    """
+    def __init__(self, model, compile_kwargs):
+        kwargs = dict(compile_kwargs)
+        lr = kwargs.pop('lr')
+        model.compile(optimizer=optimizers.Adam(lr=lr), **kwargs)
+        self.model = model
+        self.metrics_names = model.metrics_names
+        self.gradient_shapes = [K.int_shape(w) for w in model.trainable_weights]
+
+        # Gradients of the total loss for the shard of one worker
+        weights = model.trainable_weights
+        self.inputs = model.inputs + model.targets + model.sample_weights
+        self.uses_learning_phase = model.uses_learning_phase and not isinstance(K.learning_phase(), int)
+        if self.uses_learning_phase:
+            self.inputs += [K.learning_phase()]
+        grads = K.gradients(model.total_loss, weights)
+        self.grad_fn = K.function(self.inputs, [model.total_loss] + model.metrics_tensors + grads)
+
+        # Adam update with the averaged gradients fed from outside
+        placeholders = [K.placeholder(shape=K.int_shape(w)) for w in weights]
+        model.optimizer.get_gradients = lambda loss, params: placeholders
+        updates = model.optimizer.get_updates(loss=model.total_loss, params=weights)
+        self.apply_fn = K.function(placeholders, [], updates=updates)
+
+    def compute(self, x, y):
+        """ :return (number of samples, metrics, gradients) of the batch x, y
+        """
+        feed = list(x) + list(y) + [np.ones(len(y[0]), dtype=np.float32) for _ in y]
+        if self.uses_learning_phase:
+            feed += [1.]
+
+        outputs = self.grad_fn(feed)
+        num_metrics = len(self.metrics_names)
+        return len(y[0]), outputs[:num_metrics], outputs[num_metrics:]
+
+    def apply(self, grads):
+        self.apply_fn(grads)
+
+    def set_lr(self, lr):
+        K.set_value(self.model.optimizer.lr, lr)
+
+
+class GradientBuffer(object):
+    """ Gradients of all replicas in one float32 array in shared memory (/dev/shm). Replica k writes
+        its gradients into row k, the master reduces the rows in place into the last row and every
+        replica applies the average from there. Only small control messages go over the pipes.
+
+        :param shapes: Shapes of the trainable weights
+        :param num_replicas: Number of replicas including the master
+        :param path: File of an existing buffer to attach to. A new one is created if None
+    """
+    def __init__(self, shapes, num_replicas, path=None):
+        self.shapes = shapes
+        self.offsets = np.cumsum([0] + [int(np.prod(s)) for s in shapes])
+        self.owner = path is None
+        if self.owner:
+            fd, path = tempfile.mkstemp(prefix='capsnet-grads-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+            os.close(fd)
+        self.path = path
+        self.array = np.memmap(path, dtype=np.float32, mode='w+' if self.owner else 'r+',
+                               shape=(num_replicas + 1, int(self.offsets[-1])))
+
+    def write(self, row, grads, weight):
+        """ Store the gradients of a replica multiplied by weight (its number of samples)
+        """
+        for grad, start, end in zip(grads, self.offsets[:-1], self.offsets[1:]):
+            np.multiply(np.ravel(grad), weight, out=self.array[row, start:end])
+
+    def reduce(self, total):
+        """ Sum the rows of all replicas into the last row and divide by total
+        """
+        average = self.array[-1]
+        np.sum(self.array[:-1], axis=0, out=average)
+        average /= total
+
+    def average(self):
+        """ :return List of views of the averaged gradients in the shapes of the weights
+        """
+        return [self.array[-1, start:end].reshape(shape)
+                for shape, start, end in zip(self.shapes, self.offsets[:-1], self.offsets[1:])]
+
+    def close(self):
+        del self.array
+        if self.owner:
+            os.remove(self.path)
+
+
+def set_num_threads(num_threads, model=None):
+    """ Create a new TF session with num_threads intra op threads. The weights of model are kept,
+        the optimizer state is reset.
+    """
+    weights = model.get_weights() if model is not None else None
+    # Otherwise the old session and its buffers stay alive
+    K.get_session().close()
+    session_config.new_session(num_threads, 1)
+    if model is not None:
+        model.set_weights(weights)
+
+
+def _worker(conn, build_fn, build_args, compile_kwargs, num_threads, buffer_path, num_replicas, row):
+    """ Main loop of a worker process. Builds its own replica and executes the commands of the master.
+        The gradients are exchanged through row of the shared GradientBuffer.
+    """
+    set_num_threads(num_threads)
+    replica = Replica(build_fn(*build_args), compile_kwargs)
+    buffer = GradientBuffer(replica.gradient_shapes, num_replicas, buffer_path)
+
+    while True:
+        cmd, payload = conn.recv()
+        if cmd == 'weights':
+            replica.model.set_weights(payload)
+        elif cmd == 'lr':
+            replica.set_lr(payload)
+        elif cmd == 'compute':
+            num_samples, metrics, grads = replica.compute(*payload)
+            buffer.write(row, grads, num_samples)
+            conn.send((num_samples, metrics))
+        elif cmd == 'apply':
+            replica.apply(buffer.average())
+        elif cmd == 'stop':
+            break
+    buffer.close()
+    conn.close()
+
+
+class DataParallelTrainer(object):
+    """ Synchronous data-parallel training on one machine. Every batch is split into num_workers
+        shards. The master process computes the gradients of the first shard, num_workers-1
+        worker processes compute the others. The gradients are averaged in a shared memory buffer
+        (see GradientBuffer) and every replica applies the same Adam update.
+
+        :param replica: Replica of the master process
+        :param build_fn: Picklable function that creates the uncompiled training model in the workers
+        :param build_args: Arguments of build_fn
+        :param compile_kwargs: Same as for Replica
+        :param num_workers: Number of processes including the master
+    """
+    def __init__(self, replica, build_fn, build_args, compile_kwargs, num_workers):
+        self.replica = replica
+        self.num_workers = num_workers
+        # Only the cores the process is pinned to
+        num_threads = max(1, len(os.sched_getaffinity(0)) // num_workers)
+        set_num_threads(num_threads, replica.model)
+        self.buffer = GradientBuffer(replica.gradient_shapes, num_workers)
+
+        # Spawn instead of fork, a forked TF session is not usable
+        ctx = multiprocessing.get_context('spawn')
+        self.conns, self.processes = [], []
+        for row in range(1, num_workers):
+            conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(child_conn, build_fn, build_args, compile_kwargs, num_threads,
+                                                        self.buffer.path, num_workers, row))
+            process.start()
+            self.conns.append(conn)
+            self.processes.append(process)
+
+        weights = replica.model.get_weights()
+        for conn in self.conns:
+            conn.send(('weights', weights))
+
+    def train_on_batch(self, x, y):
+        """ Run one synchronous step on the batch and return the metrics of the whole batch.
+        """
+        shards = np.array_split(np.arange(len(y[0])), self.num_workers)
+        for conn, shard in zip(self.conns, shards[1:]):
+            conn.send(('compute', ([i[shard] for i in x], [i[shard] for i in y])))
+        num_samples, metrics, grads = self.replica.compute([i[shards[0]] for i in x], [i[shards[0]] for i in y])
+        self.buffer.write(0, grads, num_samples)
+        results = [(num_samples, metrics)] + [conn.recv() for conn in self.conns]
+
+        # Weighted average, because the shards may differ by one sample
+        total = float(sum(r[0] for r in results))
+        metrics = [sum(r[0] * r[1][i] for r in results) / total for i in range(len(results[0][1]))]
+        self.buffer.reduce(total)
+
+        # The average is in its own row, so the next step may write row 0 while the workers still apply
+        for conn in self.conns:
+            conn.send(('apply', None))
+        self.replica.apply(self.buffer.average())
+        return metrics
+
+    def set_lr(self, lr):
+        for conn in self.conns:
+            conn.send(('lr', lr))
+        self.replica.set_lr(lr)
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(('stop', None))
+        for process in self.processes:
+            process.join()
+        self.buffer.close()
+
+
+def fit(trainer, generator, steps_per_epoch, epochs, validation_data, lr_schedule, save_dir,
+        batch_size, monitor='val_capsnet_acc'):
+    """ Training loop for a DataParallelTrainer. Writes log.csv and the best weights
+        (weights-<epoch>.hdf5) into save_dir like the callbacks of the single process training.
+    """
+    model = trainer.replica.model
+    names = trainer.replica.metrics_names
+    fields = ['epoch'] + names + ['val_' + n for n in names] + ['lr', 'samples_per_sec']
+    best = -np.inf
+
+    with open(os.path.join(save_dir, 'log.csv'), 'w') as f:
+        log = csv.DictWriter(f, fieldnames=fields)
+        log.writeheader()
+
+        for epoch in range(epochs):
+            lr = lr_schedule(epoch)
+            trainer.set_lr(lr)
+            print("Epoch %d/%d" % (epoch + 1, epochs))
+
+            start, samples, metrics = time.time(), 0, np.zeros(len(names))
+            for step in range(steps_per_epoch):
+                x, y = next(generator)
+                metrics += trainer.train_on_batch(x, y)
+                samples += len(y[0])
+                sys.stdout.write("\r%d/%d - " % (step + 1, steps_per_epoch) +
+                                 " - ".join("%s: %.4f" % (n, m / (step + 1)) for n, m in zip(names, metrics)))
+                sys.stdout.flush()
+
+            row = dict(zip(names, metrics / steps_per_epoch))
+            row.update(epoch=epoch, lr=lr, samples_per_sec=samples / (time.time() - start))
+            val_x, val_y = validation_data
+            val_metrics = model.evaluate(val_x, val_y, batch_size=batch_size, verbose=0)
+            row.update(('val_' + n, m) for n, m in zip(names, val_metrics))
+            log.writerow(row)
+            f.flush()
+            print(" - " + " - ".join("val_%s: %.4f" % (n, m) for n, m in zip(names, val_metrics)))
+
+            if row.get(monitor, -np.inf) > best:
+                best = row[monitor]
+                filename = os.path.join(save_dir, 'weights-%02d.hdf5' % (epoch + 1))
+                model.save_weights(filename)
+                print("%s improved to %.4f, saving model to %s" % (monitor, best, filename))
+
+    trainer.close()
+    return model
+
+
+def scaling_study(model, build_fn, build_args, compile_kwargs, batch, max_workers, steps=10, warmup=2):
+    """ Measure the throughput of one synchronous step for 1 to max_workers workers on the same batch.
+        The scaling efficiency of n workers is throughput(n) / (n * throughput(1)).
+
+        :param batch: (x, y) of one training batch as yielded by the training generator
+        :return List of dicts with workers, samples_per_sec and efficiency
+    """
+    replica = Replica(model, compile_kwargs)
+    x, y = batch
+    results = []
+    for num_workers in range(1, max_workers + 1):
+        trainer = DataParallelTrainer(replica, build_fn, build_args, compile_kwargs, num_workers)
+        for _ in range(warmup):
+            trainer.train_on_batch(x, y)
+
+        start = time.time()
+        for _ in range(steps):
+            trainer.train_on_batch(x, y)
+        samples_per_sec = len(y[0]) * steps / (time.time() - start)
+        trainer.close()
+
+        efficiency = samples_per_sec / (num_workers * results[0]['samples_per_sec']) if results else 1.
+        results.append(dict(workers=num_workers, samples_per_sec=samples_per_sec, efficiency=efficiency))
+        print("workers = %d: %.1f samples/sec, efficiency %.2f" % (num_workers, samples_per_sec, efficiency))
+
+    return results
+
+
+def save_scaling_study(results, filename):
+    with open(filename, 'w') as out:
+        json.dump(results, out, indent=2)
+    print("Scaling study saved to %s" % filename)
@@ -0,0 +1,147 @@
+import os
+import sys
+import h5py
+import numpy as np
+
+from keras import models
+
+
+def build_extractor(model, layer_names):
+    """ Build one multi-output model that returns the activations of all given layers.
+
+        :param model: Keras model that contains the layers (e.g. eval_model)
+        :param layer_names: Names of the layers to probe, e.g. ['conv1', 'primary_caps', 'capsnet']
+        :return Model with the inputs of model and one output per layer name
+    """
+    outputs = [_layer_output(model, name) for name in layer_names]
+    return models.Model(model.inputs, outputs)
+
+
+def extract_activations(model, layer_names, x, out_dir, batch_size=100):
+    """ Run the given data in batches through an extractor model and stream the
+        activations of every layer into a memmapped .npy file in out_dir.
+
+        :param model: Keras model that contains the layers
+        :param layer_names: Names of the layers to probe
+        :param x: Input data of shape (num_samples, ...) or list of inputs for multi input models
+        :param out_dir: Directory for the files <layer_name>.npy
+        :param batch_size: Number of samples per graph call
+        :return Dict layer_name -> memmapped array of shape (num_samples, ...)
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    extractor = build_extractor(model, layer_names)
+    inputs = x if type(x) is list else [x]
+    num_samples = len(inputs[0])
+
+    # Create one memmap per layer. The shapes are known from the graph,
+    # so nothing has to be kept in memory
+    activations = {}
+    for name, shape in zip(layer_names, _output_shapes(extractor)):
+        path = os.path.join(out_dir, "%s.npy" % name)
+        activations[name] = np.lib.format.open_memmap(path, mode='w+', dtype='float32',
+                                                      shape=(num_samples,) + tuple(shape[1:]))
+
+    for start in range(0, num_samples, batch_size):
+        batch = [i[start:start+batch_size] for i in inputs]
+        outputs = extractor.predict_on_batch(batch)
+        if len(layer_names) == 1:
+            outputs = [outputs]
+
+        for name, output in zip(layer_names, outputs):
+            activations[name][start:start+len(output)] = output
+
+    for name in layer_names:
+        activations[name].flush()
+
+    return activations
+
+
+def load_activations(out_dir, layer_names):
+    """ Open activations written by extract_activations without reading them into memory.
+    """
+    return {name: np.load(os.path.join(out_dir, "%s.npy" % name), mmap_mode='r') for name in layer_names}
+
+
+def build_routing_extractor(model, layer_name):
+    """ Build a model that outputs [v_j, c_ij, b_ij] of the given CapsuleLayer. The routing is computed
+        by a copy of the layer with return_routing=True that shares the trained weights.
+
+        :param model: Keras model that contains the CapsuleLayer
+        :param layer_name: Name of the CapsuleLayer
+    """
+    layer = model.get_layer(layer_name)
+    # Same class as the layer, e.g. a FactorizedCapsuleLayer also needs its rank
+    kwargs = dict(rank=layer.rank) if hasattr(layer, 'rank') else {}
+    routing_layer = type(layer)(num_capsule=layer.num_capsule,
+                                dim_vector=layer.dim_vector,
+                                num_routing=layer.num_routing,
+                                return_routing=True,
+                                name=layer_name + '_routing',
+                                **kwargs)
+    outputs = routing_layer(layer.input)
+    routing_layer.set_weights(layer.get_weights())
+    return models.Model(model.inputs, outputs)
+
+
+def export_routing(model, layer_name, x, path, batch_size=100, sample_ids=None):
+    """ Stream the final coupling coefficients c_ij and log priors b_ij of a whole dataset
+        into a compressed float16 HDF5 store. Each sample is stored in its own chunk, so single
+        samples can be read without decompressing the rest of the store.
+
+        :param model: Keras model that contains the CapsuleLayer
+        :param layer_name: Name of the CapsuleLayer
+        :param x: Input data of shape (num_samples, ...)
+        :param path: Path of the HDF5 file
+        :param sample_ids: Ids stored for every sample. Default is the index into x
+        :return Path of the HDF5 file with the datasets c_ij, b_ij and sample_id
+    """
+    extractor = build_routing_extractor(model, layer_name)
+    num_samples = len(x)
+    if sample_ids is None:
+        sample_ids = np.arange(num_samples)
+
+    _, c_shape, b_shape = extractor.output_shape
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('sample_id', data=np.asarray(sample_ids, dtype=np.int64))
+        c_ij = f.create_dataset('c_ij', shape=(num_samples,) + c_shape[1:], dtype=np.float16,
+                                chunks=(1,) + c_shape[1:], compression='gzip')
+        b_ij = f.create_dataset('b_ij', shape=(num_samples,) + b_shape[1:], dtype=np.float16,
+                                chunks=(1,) + b_shape[1:], compression='gzip')
+
+        for start in range(0, num_samples, batch_size):
+            sys.stdout.write("\rExport routing: {0}%".format(int(start * 100 / num_samples)))
+            sys.stdout.flush()
+
+            _, c_batch, b_batch = extractor.predict_on_batch(x[start:start+batch_size])
+            c_ij[start:start+len(c_batch)] = c_batch.astype(np.float16)
+            b_ij[start:start+len(b_batch)] = b_batch.astype(np.float16)
+
+    print("\nRouting coefficients of %d samples saved to %s" % (num_samples, path))
+    return path
+
+
+def _layer_output(model, name):
+    """ Return the output tensor of the layer inside of model. Shared layers (e.g. the decoder)
+        are called once per model, so we take the node that is connected to the inputs of model.
+    """
+    layer = model.get_layer(name)
+    num_nodes = len(getattr(layer, '_inbound_nodes', getattr(layer, 'inbound_nodes', [])))
+    if num_nodes <= 1:
+        return layer.output
+
+    for node_index in range(num_nodes):
+        output = layer.get_output_at(node_index)
+        try:
+            models.Model(model.inputs, output)
+            return output
+        except (RuntimeError, ValueError):  # Graph disconnected
+            continue
+
+    raise ValueError("Layer %s is not connected to the inputs of the model." % name)
+
+
+def _output_shapes(model):
+    shapes = model.output_shape
+    return shapes if type(shapes) is list else [shapes]
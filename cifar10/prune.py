@@ -0,0 +1,173 @@
+import os
+import csv
+import numpy as np
+import tensorflow as tf
+
+from keras import callbacks, layers, models
+from keras import backend as K
+
+import utils
+from capsule import CapsuleLayer, Length
+
+
+class BlockPruning(callbacks.Callback):
+    """ Iterative magnitude pruning of the transformation matrices W_ij of a CapsuleLayer during
+        fine-tuning. A block is the (dim_vector x input_dim_vector) matrix from input capsule i to
+        class j and is pruned by its Frobenius norm. The sparsity grows with the polynomial schedule
+            s_t = s_f - s_f * (1 - (t - t_0) / (t_1 - t_0))^3
+        from step t_0 to t_1 (see Zhu and Gupta, To prune, or not to prune). After every batch the
+        pruned blocks are set to zero again, so the optimizer cannot revive them.
+
+        :param layer_name: Name of the CapsuleLayer
+        :param sparsity: Final fraction of pruned blocks
+        :param start_step: First step of the schedule
+        :param end_step: Step where the final sparsity is reached
+        :param freq: Update the mask every freq steps
+        :param granularity: 'block' prunes single blocks W_ij, 'input' all blocks of an input capsule i
+        :param initial_step: Steps already trained, e.g. initial_epoch * steps_per_epoch of a resumed training
+    """
+    def __init__(self, layer_name, sparsity, start_step, end_step, freq=100, granularity='block', initial_step=0):
+        super(BlockPruning, self).__init__()
+        self.layer_name = layer_name
+        self.sparsity = sparsity
+        self.start_step = start_step
+        self.end_step = end_step
+        self.freq = freq
+        self.granularity = granularity
+        self.step = initial_step
+
+    def on_train_begin(self, logs=None):
+        W = _dense_capsule_layer(self.model, self.layer_name).W
+        self.mask = K.variable(np.ones(K.int_shape(W)), name='pruning_mask')
+        self.apply_mask = tf.assign(W, W * self.mask)
+
+        # A resumed training continues the schedule, the restored W has zeros in the pruned blocks
+        if self.step > self.start_step:
+            K.set_value(self.mask, block_mask(K.get_value(W), self.current_sparsity(), self.granularity))
+
+    def on_batch_end(self, batch, logs=None):
+        self.step += 1
+        if self.start_step <= self.step <= self.end_step and \
+                ((self.step - self.start_step) % self.freq == 0 or self.step == self.end_step):
+            W = K.get_value(self.model.get_layer(self.layer_name).W)
+            K.set_value(self.mask, block_mask(W, self.current_sparsity(), self.granularity))
+        K.get_session().run(self.apply_mask)
+
+    def on_epoch_end(self, epoch, logs=None):
+        # Logged by CSVLogger if this callback is called before it
+        if logs is not None:
+            logs['sparsity'] = 1. - float(np.mean(block_norms(K.get_value(self.mask)) > 0))
+
+    def current_sparsity(self):
+        progress = min(1., max(0., (self.step - self.start_step) / float(max(self.end_step - self.start_step, 1))))
+        return self.sparsity - self.sparsity * (1. - progress) ** 3
+
+
+def block_norms(W):
+    """ Frobenius norm of every block W_ij of W with shape (1, num_capsule, input_num_capsule, dim_vector, input_dim_vector)
+
+        :return Array of shape (num_capsule, input_num_capsule)
+    """
+    return np.sqrt(np.sum(np.square(W), axis=(0, 3, 4)))
+
+
+def block_mask(W, sparsity, granularity='block'):
+    """ Mask of the shape of W that zeroes the given fraction of blocks with the smallest norm.
+        Already pruned blocks have a norm of zero, so the pruned set only grows.
+    """
+    norms = block_norms(W)
+    if granularity == 'input':
+        norms = np.tile(np.sqrt(np.sum(np.square(norms), axis=0, keepdims=True)), (norms.shape[0], 1))
+
+    num_pruned = int(sparsity * norms.size)
+    if granularity == 'input':
+        # Only whole input capsules
+        num_pruned = int(sparsity * norms.shape[1]) * norms.shape[0]
+    keep = np.ones(norms.size, dtype=np.float32)
+    keep[np.argsort(norms, axis=None, kind='mergesort')[:num_pruned]] = 0.
+    keep = keep.reshape(norms.shape)
+    return np.broadcast_to(keep[None, :, :, None, None], W.shape).astype(np.float32)
+
+
+def kept_input_capsules(W):
+    """ Indices of the input capsules with at least one non-zero block. All others produce
+        u_hat = 0 for every class and can be dropped without changing the routing.
+    """
+    return np.nonzero(np.any(block_norms(W) > 0, axis=0))[0]
+
+
+def build_sparse_model(model, layer_name):
+    """ Build a classification model that gathers only the kept input capsules before the CapsuleLayer,
+        so u_hat and all routing iterations shrink with the number of dropped input capsules.
+        The convolutions in front still compute all positions.
+
+        :param model: Keras model that contains the CapsuleLayer, e.g. fool_model
+        :param layer_name: Name of the CapsuleLayer
+        :return (sparse model with the capsule lengths as output, number of kept input capsules)
+    """
+    layer = _dense_capsule_layer(model, layer_name)
+    W = layer.get_weights()[0]
+    kept = kept_input_capsules(W)
+
+    u = layers.Lambda(lambda u: tf.gather(u, kept, axis=1), name=layer_name + '_kept_inputs')(layer.input)
+    sparse_layer = CapsuleLayer(num_capsule=layer.num_capsule,
+                                dim_vector=layer.dim_vector,
+                                num_routing=layer.num_routing,
+                                name=layer_name + '_sparse')
+    v = sparse_layer(u)
+    sparse_layer.set_weights([W[:, :, kept]])
+    return models.Model(model.inputs, Length()(v)), len(kept)
+
+
+def report(model, layer_name, data, path, sparsities=(0., 0.25, 0.5, 0.75, 0.9, 0.95),
+           granularity='block', batch_size=100, repeats=10, label=''):
+    """ One-shot magnitude pruning of the current weights for every sparsity. Accuracy and latency
+        of the sparse model are appended to a csv file. Run it on the dense and on the fine-tuned
+        weights to compare both. The weights of model are restored afterwards.
+
+        :param model: Classification model that contains the CapsuleLayer, e.g. fool_model
+        :param data: (x_test, y_test)
+        :param path: csv file
+        :param label: Written into every row, e.g. the weights file
+    """
+    x_test, y_test = data
+    layer = _dense_capsule_layer(model, layer_name)
+    weights = layer.get_weights()
+    fields = ['label', 'granularity', 'target_sparsity', 'block_sparsity', 'kept_input_capsules',
+              'input_num_capsule', 'accuracy', 'latency_ms', 'batch_size']
+
+    rows = []
+    for sparsity in sparsities:
+        W = weights[0] * block_mask(weights[0], sparsity, granularity)
+        layer.set_weights([W] + weights[1:])
+        sparse_model, num_kept = build_sparse_model(model, layer_name)
+
+        row = dict(label=label, granularity=granularity, target_sparsity=sparsity,
+                   block_sparsity=1. - float(np.mean(block_norms(W) > 0)),
+                   kept_input_capsules=num_kept, input_num_capsule=W.shape[2],
+                   accuracy=utils.accuracy(sparse_model, x_test, y_test, batch_size),
+                   latency_ms=utils.latency_ms(sparse_model, x_test[:batch_size], repeats),
+                   batch_size=batch_size)
+        rows.append(row)
+        print("sparsity %.2f: %d/%d input capsules, accuracy %.4f, %.2f ms per batch" % (
+              row['block_sparsity'], num_kept, W.shape[2], row['accuracy'], row['latency_ms']))
+
+    layer.set_weights(weights)
+
+    write_header = not os.path.exists(path)
+    with open(path, 'a') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        if write_header:
+            writer.writeheader()
+        writer.writerows(rows)
+    print("Pruning report saved to %s" % path)
+    return rows
+
+
+def _dense_capsule_layer(model, layer_name):
+    """ The blocks are the matrices W_ij of a CapsuleLayer, other capsule layers have no dense W
+    """
+    layer = model.get_layer(layer_name)
+    if type(layer) is not CapsuleLayer:
+        raise ValueError("Pruning needs a CapsuleLayer with dense W, %s is a %s" % (layer_name, type(layer).__name__))
+    return layer
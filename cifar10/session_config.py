@@ -0,0 +1,88 @@
+import os
+import time
+import numpy as np
+import tensorflow as tf
+
+from keras import backend as K
+
+import pinning
+
+
+def configure_session(intra_op_threads=0, inter_op_threads=0, cpus=None, numa_node=None):
+    """ Pin the process to the given cores and create the TF session with the given thread pools.
+        Must be called before the first session is used. The MKL / OpenMP pools only follow the
+        pinning if pinning.pin ran before TF was loaded, the entry scripts do so via pin_from_argv.
+
+        :param intra_op_threads: Threads used inside of one op (e.g. a matmul). 0 uses one per available core
+        :param inter_op_threads: Ops run in parallel. 0 uses the TF default
+        :param cpus: Cores to pin the process to, e.g. "0-7,16-23"
+        :param numa_node: Pin the process to the cores of this NUMA node
+        :return Dict with the applied configuration, e.g. for args.txt
+    """
+    config = pinning.pin(intra_op_threads, cpus, numa_node)
+    new_session(config['intra_op_threads'], inter_op_threads)
+    config.update(inter_op_threads=inter_op_threads)
+    return config
+
+
+def new_session(intra_op_threads, inter_op_threads):
+    """ Replace the Keras session. The variables of the graph are initialized again,
+        so weights have to be restored by the caller.
+    """
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                            inter_op_parallelism_threads=inter_op_threads)
+    session = tf.Session(config=config)
+
+    # Keras initializes every variable only once, so the new session has to do it
+    session.run(tf.global_variables_initializer())
+    K.set_session(session)
+
+
+def autotune(model, x, y, candidates=None, warmup=2, steps=5):
+    """ Time train_on_batch of a compiled model for a small grid of thread settings and keep the
+        session of the fastest one. The weights are restored and the optimizer state is reset after
+        every trial, so training starts from the same state as without tuning.
+
+        :param x: Inputs of one training batch
+        :param y: Targets of one training batch
+        :param candidates: List of (intra_op_threads, inter_op_threads). Default depends on the available cores
+        :return Dict with the fastest configuration and its median step time
+    """
+    if candidates is None:
+        num_cpus = len(os.sched_getaffinity(0))
+        intra = sorted(set(max(1, num_cpus // d) for d in [1, 2, 4]), reverse=True)
+        candidates = [(i, j) for i in intra for j in [1, 2]]
+
+    weights = model.get_weights()
+    results = []
+    for intra_op_threads, inter_op_threads in candidates:
+        K.get_session().close()
+        new_session(intra_op_threads, inter_op_threads)
+        model.set_weights(weights)
+        for _ in range(warmup):
+            model.train_on_batch(x, y)
+
+        times = []
+        for _ in range(steps):
+            start = time.perf_counter()
+            model.train_on_batch(x, y)
+            times.append(time.perf_counter() - start)
+
+        step_ms = float(np.median(times) * 1000)
+        results.append((step_ms, intra_op_threads, inter_op_threads))
+        print("intra_op_threads = %d, inter_op_threads = %d: %.1f ms/step" % (intra_op_threads, inter_op_threads, step_ms))
+
+    step_ms, intra_op_threads, inter_op_threads = min(results)
+    K.get_session().close()
+    new_session(intra_op_threads, inter_op_threads)
+    model.set_weights(weights)
+    print("Using intra_op_threads = %d, inter_op_threads = %d" % (intra_op_threads, inter_op_threads))
+
+    return dict(intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads, step_ms=step_ms)
+
+
+def log_config(config, filename):
+    """ Append the applied session configuration to args.txt
+    """
+    with open(filename, "a") as out:
+        out.write('\n' + '\n'.join("session_{0} = {1}".format(k, v) for (k, v) in sorted(config.items())) + '\n')
@@ -1,12 +1,18 @@
+import io
+import os
 import numpy as np
 from matplotlib import pyplot as plt
 import csv
 import math
+import time
+import h5py
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 
 
-def plot_log(filename, show=True):
+def plot_log(filename, show=True, writer=None):
     """ https://github.com/XifengGuo/CapsNet-Keras/blob/master/utils.py
+        If an ArtifactWriter is given the plot is saved as log.png
     """
 
     # load data
@@ -43,46 +49,260 @@ def plot_log(filename, show=True):
     plt.legend()
     plt.title('Training and validation accuracy')
 
-    # fig.savefig('result/log.png')
+    if writer is not None:
+        writer.save_figure(fig, 'log.png')
     if show:
         plt.show()
 
 
+def tile_images(x, cols, rows=None, pad=0):
+    """ Compose images of shape (n, height, width, channels) into one grid in a single pass
+        via reshape and transpose. Missing cells are filled with zeros and every cell
+        gets pad pixels of zeros at its right and bottom border.
+
+        :return Array of shape (rows*(height+pad), cols*(width+pad), channels)
+    """
+    x = np.asarray(x)
+    if rows is None:
+        rows = int(math.ceil(float(len(x)) / cols))
+
+    num, height, width, channels = x.shape
+    grid = np.zeros((rows * cols, height + pad, width + pad, channels), dtype=x.dtype)
+    grid[:min(num, rows * cols), :height, :width] = x[:rows * cols]
+    grid = grid.reshape(rows, cols, height + pad, width + pad, channels).transpose(0, 2, 1, 3, 4)
+    return grid.reshape(rows * (height + pad), cols * (width + pad), channels)
+
+
+def _to_rgb_image(grid):
+    if grid.dtype != np.uint8:
+        grid = (grid * 255).astype(np.uint8)
+    if grid.shape[-1] == 1:
+        return Image.fromarray(grid[:, :, 0]).convert('RGB')
+    return Image.fromarray(grid)
+
+
 def stack_images_two_arrays(x_augmented, x_recon, rows, cols):
     """ Stack images together and return the image for two arrays.
         So the first row shows the first array and the second the second etc.
     """
-    width = x_augmented[0].shape[0]
-    height = x_augmented[0].shape[1]
-    stacked_img = Image.new('RGB', (rows*(width+5), cols*(height+5)))
-    for i in range(rows):
-        for j in range(cols):
-            img_augmented = Image.fromarray((x_augmented[i*rows + j]*255).astype(np.uint8))
-            img_recon = Image.fromarray((x_recon[i*rows + j]*255).astype(np.uint8))
-            
-            pos = (j * (width+5), i * (height+5) * 2)
-            stacked_img.paste(img_augmented, pos)
-            stacked_img.paste(img_recon, (pos[0], pos[1]+height))
-
-    return stacked_img
+    num = rows * cols
+    pairs = np.concatenate([np.asarray(x_augmented[:num]), np.asarray(x_recon[:num])], axis=1)
+    return _to_rgb_image(tile_images(pairs, cols, rows, pad=5))
 
 
 def stack_images(x, cols):
     """ Stack images by row together and return the image.
     """
-    width = x[0].shape[0]
-    height = x[0].shape[1]
     rows = int(len(x) / cols)
+    return _to_rgb_image(tile_images(x[:rows * cols], cols, rows))
+
+
+class ArtifactWriter(object):
+    """ Write images and arrays in a background thread pool, so that the test loop
+        does not block on PNG encoding and disk I/O. Call close() to wait for all writes.
+
+        :param save_dir: Directory for all artifacts
+        :param headless: Do not show any image if True
+        :param max_workers: Number of writer threads
+    """
+    def __init__(self, save_dir, headless=False, max_workers=4):
+        self.save_dir = save_dir
+        self.headless = headless
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = []
+        self._misclassified = None
+
+    def save_image(self, img, filename):
+        """ Save a PIL image or a float array with values in [0, 1].
+        """
+        self._submit(_save_image, img, os.path.join(self.save_dir, filename))
+
+    def save_npz(self, filename, **arrays):
+        self._submit(np.savez_compressed, os.path.join(self.save_dir, filename), **arrays)
+
+    def save_figure(self, fig, filename):
+        """ Render the figure in the calling thread, matplotlib figures are not thread-safe.
+            Only the file is written in the background.
+        """
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format=os.path.splitext(filename)[1][1:] or 'png')
+        self._submit(_write_bytes, buffer.getvalue(), os.path.join(self.save_dir, filename))
+
+    def save_misclassified(self, x, y_true, y_pred, pack='png', index=None, cols=20):
+        """ Save the samples where y_true != y_pred. Call it once per batch, only the current batch
+            is kept in memory.
+
+            :param pack: 'png' writes wrongly_classified_<i>.png per sample right away. 'npz' and 'sprite'
+                         append the samples to a temporary HDF5 file, which close() packs into
+                         wrongly_classified.npz or one wrongly_classified.png
+            :param index: Sample id of every entry of x. Default is the position in x
+        """
+        y_true, y_pred = np.asarray(y_true), np.asarray(y_pred)
+        index = np.arange(len(y_true)) if index is None else np.asarray(index)
+        wrong = np.nonzero(y_true != y_pred)[0]
+        if len(wrong) == 0:
+            return
+
+        if pack == 'png':
+            for i in wrong:
+                self.save_image(x[i], "wrongly_classified_%d.png" % index[i])
+            return
+
+        images = (np.asarray(x)[wrong] * 255).astype(np.uint8)
+        if self._misclassified is None:
+            self._misclassified = _MisclassifiedStore(os.path.join(self.save_dir, "wrongly_classified.h5.tmp"),
+                                                      images.shape[1:], pack, cols)
+        self._misclassified.append(images, index[wrong], y_true[wrong], y_pred[wrong])
+
+    def show(self, img):
+        if not self.headless:
+            img.show()
+
+    def close(self):
+        """ Wait until all artifacts are written and raise the first error, if any.
+        """
+        if self._misclassified is not None:
+            self._submit(self._misclassified.finish, self.save_dir)
+            self._misclassified = None
+
+        for future in self._futures:
+            future.result()
+        self._futures = []
+        self._executor.shutdown()
+
+    def _submit(self, fn, *args, **kwargs):
+        self._futures.append(self._executor.submit(fn, *args, **kwargs))
+
+
+class _MisclassifiedStore(object):
+    """ Resizable HDF5 datasets that collect the misclassified samples of all batches on disk
+    """
+    def __init__(self, path, image_shape, pack, cols):
+        self.path = path
+        self.pack = pack
+        self.cols = cols
+        self.file = h5py.File(path, 'w')
+        self.images = self.file.create_dataset('images', (0,) + tuple(image_shape), dtype='uint8',
+                                               maxshape=(None,) + tuple(image_shape), chunks=(1,) + tuple(image_shape))
+        # index, y_true and y_pred of every sample
+        self.labels = self.file.create_dataset('labels', (0, 3), dtype='int64', maxshape=(None, 3), chunks=(1024, 3))
+
+    def append(self, images, index, y_true, y_pred):
+        start = len(self.images)
+        self.images.resize(start + len(images), axis=0)
+        self.labels.resize(start + len(images), axis=0)
+        self.images[start:] = images
+        self.labels[start:] = np.stack([index, y_true, y_pred], axis=1)
+
+    def finish(self, save_dir):
+        """ Pack the collected samples into wrongly_classified.npz or .png and remove the temporary file
+        """
+        images, labels = self.images[:], self.labels[:]
+        self.file.close()
+        os.remove(self.path)
+
+        if self.pack == 'npz':
+            np.savez_compressed(os.path.join(save_dir, "wrongly_classified.npz"), images=images,
+                                index=labels[:, 0], y_true=labels[:, 1], y_pred=labels[:, 2])
+        else:
+            sprite = _to_rgb_image(tile_images(images, min(self.cols, len(images))))
+            _save_image(sprite, os.path.join(save_dir, "wrongly_classified.png"))
+
+
+class StreamingMetrics(object):
+    """ Accumulate a confusion matrix batch by batch with np.bincount and derive all metrics
+        from it at the end. Memory is constant in the number of samples. Recall, precision
+        and f1 are weighted by support as sklearn does for average='weighted'.
+
+        :param n_class: Number of classes
+    """
+    def __init__(self, n_class):
+        self.n_class = n_class
+        self.matrix = np.zeros((n_class, n_class), dtype=np.int64)
+
+    def update(self, y_true, y_pred):
+        """ :param y_true: Class ids of shape (batch_size,)
+            :param y_pred: Class ids of shape (batch_size,)
+        """
+        index = np.asarray(y_true, dtype=np.int64) * self.n_class + np.asarray(y_pred, dtype=np.int64)
+        self.matrix += np.bincount(index, minlength=self.n_class ** 2).reshape(self.n_class, self.n_class)
+
+    def confusion_matrix(self):
+        """ Confusion matrix of all classes that occur as label or as prediction.
+        """
+        used = (self.matrix.sum(0) + self.matrix.sum(1)) > 0
+        return self.matrix[used][:, used]
+
+    def accuracy(self):
+        return np.trace(self.matrix) / float(max(self.matrix.sum(), 1))
+
+    def recall(self):
+        return self._weighted(self._recall_per_class())
+
+    def precision(self):
+        return self._weighted(self._precision_per_class())
+
+    def f1(self):
+        precision, recall = self._precision_per_class(), self._recall_per_class()
+        return self._weighted(self._divide(2 * precision * recall, precision + recall))
+
+    def print_report(self):
+        print('Confusion matrix:\n', self.confusion_matrix())
+        print('\nAccuracy: ', self.accuracy())
+        print('Recall: ', self.recall())
+        print('Precision: ', self.precision())
+        print('F1-Score: ', self.f1())
+
+    def _recall_per_class(self):
+        return self._divide(np.diag(self.matrix), self.matrix.sum(1))
+
+    def _precision_per_class(self):
+        return self._divide(np.diag(self.matrix), self.matrix.sum(0))
+
+    def _weighted(self, per_class):
+        support = self.matrix.sum(1)
+        return float(np.sum(per_class * support)) / max(support.sum(), 1)
+
+    @staticmethod
+    def _divide(a, b):
+        # Ill-defined values (e.g. no predictions for a class) are set to 0 as in sklearn
+        a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+        return np.divide(a, b, out=np.zeros_like(a), where=b > 0)
+
+
+def accuracy(model, x, y, batch_size=100):
+    """ Accuracy of a classification model (e.g. up to Length) on one-hot labels y, computed batch by batch
+    """
+    correct = 0
+    for start in range(0, len(x), batch_size):
+        y_pred = model.predict_on_batch(x[start:start+batch_size])
+        correct += np.sum(np.argmax(y_pred, 1) == np.argmax(y[start:start+batch_size], 1))
+    return correct / float(len(x))
+
+
+def latency_ms(model, x, repeats=20):
+    """ Median time in ms of predict_on_batch(x) after one warm-up call
+    """
+    model.predict_on_batch(x)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.predict_on_batch(x)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1000)
+
+
+def _write_bytes(data, path):
+    with open(path, 'wb') as f:
+        f.write(data)
 
-    stacked_img = Image.new('RGB', (cols*(height), rows*(width)))
-    for i in range(rows):
-        for j in range(cols):
-            data = x[i * cols + j]
-            img = Image.fromarray((data * 255).astype(np.uint8))
-            pos = (j * (width), i * (height))
-            stacked_img.paste(img, pos)
 
-    return stacked_img
+def _save_image(img, path):
+    if isinstance(img, np.ndarray):
+        if img.ndim == 3 and img.shape[-1] == 1:
+            img = img[:, :, 0]
+        img = Image.fromarray((img * 255).astype(np.uint8))
+    img.save(path)
 
 
 def center_crop(x, center_crop_size, **kwargs):
@@ -0,0 +1,70 @@
+from keras import optimizers
+from keras import backend as K
+from keras.legacy import interfaces
+
+
+class AdamAccumulate(optimizers.Optimizer):
+    """ Adam that sums the gradients of accumulate_steps micro-batches and applies one update with
+        their mean. This gives the convergence of batch_size * accumulate_steps samples per update
+        while only one micro-batch (and its u_hat) is kept in memory.
+
+        The moments and the bias correction only advance when an update is applied, so the
+        optimizer behaves like Adam on the large batch. lr is the same variable as in Adam,
+        so the LearningRateScheduler callback works unchanged.
+
+        :param accumulate_steps: Number of micro-batches per update. 1 is plain Adam
+    """
+    def __init__(self, lr=0.001, beta_1=0.9, beta_2=0.999, epsilon=None, accumulate_steps=1, **kwargs):
+        super(AdamAccumulate, self).__init__(**kwargs)
+        with K.name_scope(self.__class__.__name__):
+            self.iterations = K.variable(0, dtype='int64', name='iterations')
+            self.lr = K.variable(lr, name='lr')
+            self.beta_1 = K.variable(beta_1, name='beta_1')
+            self.beta_2 = K.variable(beta_2, name='beta_2')
+        if epsilon is None:
+            epsilon = K.epsilon()
+        self.epsilon = epsilon
+        self.accumulate_steps = accumulate_steps
+
+    @interfaces.legacy_get_updates_support
+    def get_updates(self, loss, params):
+        grads = self.get_gradients(loss, params)
+        self.updates = [K.update_add(self.iterations, 1)]
+
+        # The update is applied on the last micro-batch, t counts the applied updates
+        steps = K.cast(self.accumulate_steps, 'int64')
+        apply_update = K.equal((self.iterations + 1) % steps, 0)
+        t = K.cast(self.iterations // steps + 1, K.floatx())
+        lr_t = self.lr * (K.sqrt(1. - K.pow(self.beta_2, t)) / (1. - K.pow(self.beta_1, t)))
+
+        shapes = [K.int_shape(p) for p in params]
+        ms = [K.zeros(shape) for shape in shapes]
+        vs = [K.zeros(shape) for shape in shapes]
+        gs = [K.zeros(shape) for shape in shapes]
+        self.weights = [self.iterations] + ms + vs + gs
+
+        for p, g, m, v, g_acc in zip(params, grads, ms, vs, gs):
+            g_sum = g_acc + g
+            g_t = g_sum / float(self.accumulate_steps)
+            m_t = (self.beta_1 * m) + (1. - self.beta_1) * g_t
+            v_t = (self.beta_2 * v) + (1. - self.beta_2) * K.square(g_t)
+            p_t = p - lr_t * m_t / (K.sqrt(v_t) + self.epsilon)
+
+            # Apply constraints.
+            if getattr(p, 'constraint', None) is not None:
+                p_t = p.constraint(p_t)
+
+            self.updates.append(K.update(m, K.switch(apply_update, m_t, m)))
+            self.updates.append(K.update(v, K.switch(apply_update, v_t, v)))
+            self.updates.append(K.update(g_acc, K.switch(apply_update, K.zeros_like(g_acc), g_sum)))
+            self.updates.append(K.update(p, K.switch(apply_update, p_t, p)))
+        return self.updates
+
+    def get_config(self):
+        config = {'lr': float(K.get_value(self.lr)),
+                  'beta_1': float(K.get_value(self.beta_1)),
+                  'beta_2': float(K.get_value(self.beta_2)),
+                  'epsilon': self.epsilon,
+                  'accumulate_steps': self.accumulate_steps}
+        base_config = super(AdamAccumulate, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
@@ -1,19 +1,31 @@
 import os
+import sys
 import argparse
 import numpy as np
 from PIL import Image
 import matplotlib.pyplot as plt
 
+# OpenMP and MKL read their thread settings when TF is loaded, so the process is pinned before keras is imported
+import pinning
+if __name__ == "__main__":
+    pinning.pin_from_argv(sys.argv[1:])
+
 from keras import callbacks, layers, models, optimizers
 from keras import backend as K
 from keras.utils import to_categorical
 from keras.datasets import mnist
 from keras.preprocessing.image import ImageDataGenerator
 
-from sklearn.metrics import confusion_matrix, f1_score, accuracy_score, recall_score, precision_score
-
 import utils
-from capsule import PrimaryCaps, CapsuleLayer, Length, Mask, margin_loss, reconstruction_loss
+import monitor
+import session_config
+import probe
+import freeze
+import quantize
+import mmweights
+from accumulate import AdamAccumulate
+from checkpoint import AsyncCheckpoint
+from capsule import PrimaryCaps, CapsuleLayer, Length, Mask, ClassConditionalDense, margin_loss, reconstruction_loss
 
 
 #
@@ -30,10 +42,23 @@ def main(args):
     if not os.path.exists(args.save_dir):
             os.makedirs(args.save_dir)
 
+    # Without display we never show plots
+    if args.headless:
+        plt.switch_backend('Agg')
+
     # Save args into file 
     with open(args.save_dir+"/args.txt", "w") as out:
         out.write(str(args) + "\n")
+
+    # Configure threads and pinning before the first session is created, otherwise TF keeps its defaults
+    if args.intra_op_threads or args.inter_op_threads or args.cpus is not None or args.numa_node is not None:
+        session = session_config.configure_session(args.intra_op_threads, args.inter_op_threads, args.cpus, args.numa_node)
+        session_config.log_config(session, args.save_dir + "/args.txt")
         
+    # Set learning phase for tf
+    if args.freeze is not None or args.quantize is not None:
+        K.set_learning_phase(0)
+
     # Load data
     (x_train, y_train), (x_test, y_test) = load_mnist()
 
@@ -44,17 +69,34 @@ def main(args):
         print("\nUsing only %d training samples.\n" % len(x_train))
 
     # Create model
-    model, eval_model, manipulate_model = create_capsnet(input_shape=x_train.shape[1:],
+    model, eval_model, manipulate_model, classify_model = create_capsnet(input_shape=x_train.shape[1:],
                                                   n_class=len(np.unique(np.argmax(y_train, 1))),
-                                                  num_routing=args.num_routing)
+                                                  num_routing=args.num_routing,
+                                                  recompute_routing=args.recompute_routing,
+                                                  dense_decoder=args.dense_decoder)
     model.summary()
 
     # Run training / testing
     if args.weights is not None and os.path.exists(args.weights):
-        model.load_weights(args.weights)
+        # .mmw files are memory-mapped (see mmweights.py), all others are HDF5
+        if args.weights.endswith('.mmw'):
+            mmweights.load_weights(model, args.weights)
+        else:
+            model.load_weights(args.weights)
         print("Successfully loaded weights file %s" % args.weights)
     
-    if not args.testing:
+    if args.freeze is not None:
+        print("\n" + "=" * 40 + " FREEZE " + "=" * 39)
+        freeze.freeze_model(eval_model, args.freeze, K.get_session())
+    elif args.quantize is not None:
+        print("\n" + "=" * 40 + " QUANTIZE " + "=" * 37)
+        quantize.run(classify_model, x_train[:args.calibration_samples], (x_test, y_test), args.quantize,
+                     report_path=args.save_dir + '/quantize_report.json')
+    elif args.export_routing is not None:
+        print("\n" + "=" * 40 + " EXPORT " + "=" * 39)
+        x_export = x_test if args.export_split == 'test' else x_train
+        probe.export_routing(eval_model, 'digit_caps', x_export, args.export_routing)
+    elif not args.testing:
         print("\n" + "=" * 40 + " TRAIN " + "=" * 40)
         train(model=model, data=((x_train, y_train), (x_test, y_test)), args=args)
     else:
@@ -62,8 +104,10 @@ def main(args):
         if args.weights is None:
             print('(Warning) No weights are provided, using random initialized weights.')
 
-        test(model=eval_model, data=(x_test, y_test), args=args)
-        manipulate_latent(manipulate_model, (x_test, y_test), args)
+        writer = utils.ArtifactWriter(args.save_dir, headless=args.headless)
+        test(model=classify_model, recon_model=eval_model, data=(x_test, y_test), args=args, writer=writer)
+        manipulate_latent(manipulate_model, (x_test, y_test), args, writer)
+        writer.close()
     
     print("=" * 40 + "=======" + "=" * 40)
 
@@ -80,22 +124,27 @@ def load_mnist():
     return (x_train, y_train), (x_test, y_test)
 
 
-def create_capsnet(input_shape, n_class, num_routing):
+def create_capsnet(input_shape, n_class, num_routing, recompute_routing=False, dense_decoder=False):
     # Create CapsNet
     x = layers.Input(shape=input_shape)
     conv1 = layers.Conv2D(filters=256, kernel_size=9, strides=1, padding='valid', activation='relu', name='conv1')(x)
     primary_caps = PrimaryCaps(layer_input=conv1, name='primary_caps', dim_capsule=8, channels=32, kernel_size=9, strides=2)
-    digit_caps = CapsuleLayer(num_capsule=n_class, dim_vector=16, num_routing=num_routing)(primary_caps)
+    digit_caps = CapsuleLayer(num_capsule=n_class, dim_vector=16, num_routing=num_routing,
+                              recompute_routing=recompute_routing, name='digit_caps')(primary_caps)
     out_caps = Length(name='capsnet')(digit_caps)
 
     # Create decoder
     y = layers.Input(shape=(n_class,))
-    masked_by_y = Mask()([digit_caps, y])    # The true label is used to mask the output of capsule layer for training
-    masked = Mask()(digit_caps)              # Mask using the capsule with maximal length for prediction
+    masked_by_y = Mask(gather=not dense_decoder)([digit_caps, y])    # The true label is used to mask the output of capsule layer for training
+    masked = Mask(gather=not dense_decoder)(digit_caps)              # Mask using the capsule with maximal length for prediction
 
     # Shared Decoder model in training and prediction
     decoder = models.Sequential(name='decoder')
-    decoder.add(layers.Dense(512, activation='relu', input_dim=16*n_class))
+    if dense_decoder:
+        decoder.add(layers.Dense(512, activation='relu', input_dim=16*n_class))
+    else:
+        # Same weights as the Dense layer, but only the kernel rows of the selected class are used
+        decoder.add(ClassConditionalDense(512, n_class=n_class, activation='relu', input_shape=(16 + 1,)))
     decoder.add(layers.Dense(1024, activation='relu'))
     decoder.add(layers.Dense(np.prod(input_shape), activation='sigmoid'))
     decoder.add(layers.Reshape(target_shape=input_shape, name='decoder_output'))
@@ -104,32 +153,54 @@ def create_capsnet(input_shape, n_class, num_routing):
     train_model = models.Model([x, y], [out_caps, decoder(masked_by_y)])
     eval_model = models.Model(x, [out_caps, decoder(masked)])
 
+    # Classification-only model. It stops at Length, so Mask and decoder are not part of its graph
+    classify_model = models.Model(x, out_caps)
+
     # manipulate model
     noise = layers.Input(shape=(n_class, 16))
     noised_digit_caps = layers.Add()([digit_caps, noise])
-    masked_noised_y = Mask()([noised_digit_caps, y])
+    masked_noised_y = Mask(gather=not dense_decoder)([noised_digit_caps, y])
     manipulate_model = models.Model([x, y, noise], decoder(masked_noised_y))
 
-    return train_model, eval_model, manipulate_model
+    return train_model, eval_model, manipulate_model, classify_model
 
 
 def train(model, data, args):
     # unpacking the data
     (x_train, y_train), (x_test, y_test) = data
 
+    # Every epoch ends with an applied update
+    steps_per_epoch = int(y_train.shape[0] / args.batch_size) // args.accumulate_steps * args.accumulate_steps
+    if steps_per_epoch == 0:
+        raise ValueError("--accumulate_steps %d is larger than the %d batches of an epoch" % (
+                         args.accumulate_steps, int(y_train.shape[0] / args.batch_size)))
+
     # callbacks
-    log = callbacks.CSVLogger(args.save_dir + '/log.csv')
+    log = callbacks.CSVLogger(args.save_dir + '/log.csv', append=args.resume)
     tb = callbacks.TensorBoard(log_dir=args.save_dir + '/tensorboard-logs',
                                batch_size=args.batch_size, histogram_freq=int(args.debug))
-    checkpoint = callbacks.ModelCheckpoint(args.save_dir + '/weights-{epoch:02d}.hdf5', monitor='val_capsnet_acc',
-                                           save_best_only=True, save_weights_only=True, verbose=1)
+    # Written in the background, the last one (with optimizer state) is used by --resume
+    checkpoint = AsyncCheckpoint(args.save_dir + '/checkpoint.hdf5', args.save_dir + '/weights-{epoch:02d}.hdf5',
+                                 monitor='val_capsnet_acc')
     lr_decay = callbacks.LearningRateScheduler(schedule=lambda epoch: args.lr * (args.lr_decay ** epoch))
 
+    # Traces need run options in the train function, so they are passed to compile
+    trace_window, compile_kwargs = None, {}
+    if args.trace_steps is not None:
+        trace_start, trace_end = monitor.parse_step_window(args.trace_steps)
+        trace_window = monitor.TraceWindow(trace_start, trace_end, args.save_dir)
+        compile_kwargs = trace_window.compile_kwargs
+
+    # Accumulate the gradients of several batches to train with a larger effective batch size
+    optimizer = optimizers.Adam(lr=args.lr) if args.accumulate_steps == 1 \
+                else AdamAccumulate(lr=args.lr, accumulate_steps=args.accumulate_steps)
+
     # compile the model
-    model.compile(optimizer=optimizers.Adam(lr=args.lr),
+    model.compile(optimizer=optimizer,
                   loss=[margin_loss, reconstruction_loss],              # We scale down this reconstruction loss by 0.0005 so that
                   loss_weights=[1., args.scale_reconstruction_loss],    # ...it does not dominate the margin loss during training.
-                  metrics={'capsnet': 'accuracy'})                      
+                  metrics={'capsnet': 'accuracy'},
+                  **compile_kwargs)
 
     # Generator with data augmentation as used in [1]
     def train_generator_with_augmentation(x, y, batch_size, shift_fraction=0.):
@@ -141,25 +212,48 @@ def train(model, data, args):
             yield ([x_batch, y_batch], [y_batch, x_batch])
 
     generator = train_generator_with_augmentation(x_train, y_train, args.batch_size, args.shift_fraction)
+
+    # Pick the fastest thread configuration on the first batch
+    if args.autotune_threads:
+        x_batch, y_batch = next(generator)
+        session_config.log_config(session_config.autotune(model, x_batch, y_batch), args.save_dir + "/args.txt")
+
+    step_timer = monitor.StepTimer(args.save_dir + '/steps.csv', append=args.resume)
+    callback_list = [log, tb, checkpoint, lr_decay, step_timer]
+    if args.profile_memory:
+        callback_list.append(monitor.MemoryProfiler(args.save_dir + '/memory_report.txt', args.batch_size))
+    if trace_window is not None:
+        callback_list.append(trace_window)
+    # Routing statistics are evaluated on a small fixed batch
+    if args.routing_log_freq > 0:
+        callback_list.append(monitor.RoutingMonitor('digit_caps', x_test[:16], args.save_dir + '/tensorboard-logs/routing',
+                                                    freq=args.routing_log_freq))
+
+    # Continue with the weights, optimizer state and lr schedule of the last checkpoint
+    initial_epoch = checkpoint.restore(model) if args.resume else 0
     model.fit_generator(generator=generator,
-                        steps_per_epoch=int(y_train.shape[0] / args.batch_size),
+                        steps_per_epoch=steps_per_epoch,
                         epochs=args.epochs,
                         validation_data=[[x_test, y_test], [y_test, x_test]],   # Note: For the decoder the input is the label and the output the image
-                        callbacks=[log, tb, checkpoint, lr_decay])
+                        callbacks=callback_list,
+                        initial_epoch=initial_epoch)
 
     model.save_weights(args.save_dir + '/trained_model.hdf5')
     print('Trained model saved to \'%s/trained_model.hdf5\'' % args.save_dir)
 
-    utils.plot_log(args.save_dir + '/log.csv', show=True)
+    writer = utils.ArtifactWriter(args.save_dir, headless=args.headless)
+    utils.plot_log(args.save_dir + '/log.csv', show=not args.headless, writer=writer)
+    writer.close()
 
     return model
 
 
-def test(model, data, args):
+def test(model, recon_model, data, args, writer):
+    """ :param model: Classification-only model used for the metrics
+        :param recon_model: eval_model, only used for the reconstructions of the shown samples
+    """
 
-    # Create an augmentation function and cache augmented samples
-    # to be displayed later
-    x_augmented = []
+    # Create an augmentation function
     def test_generator_with_augmentation(x, batch_size, shift_range, rotation_range):
         test_datagen = ImageDataGenerator(width_shift_range=shift_range,
                                           height_shift_range=shift_range,
@@ -167,35 +261,43 @@ def test(model, data, args):
         generator = test_datagen.flow(x, batch_size=batch_size, shuffle=False)
         while 1:
             x_batch = generator.next()
-            x_augmented.extend(x_batch)
             yield (x_batch)
 
-    # Run predictions
+    # Run predictions batch by batch. Only the metrics and the first samples
+    # for the manual evaluation are kept in memory
     test_batch_size = 100
     x_true, y_true = data
+    metrics = utils.StreamingMetrics(n_class=y_true.shape[1])
+    x_shown, x_recon_shown = [], []
     generator = test_generator_with_augmentation(x_true, test_batch_size, args.shift_fraction, args.rotation_range)
-    y_pred, x_recon = model.predict_generator(generator=generator, steps=len(x_true) // test_batch_size)
+    for step in range(len(x_true) // test_batch_size):
+        x_batch = next(generator)
+        y_pred = model.predict_on_batch(x_batch)
 
-    # Print different metrics using the top score
-    y_true = np.argmax(y_true, 1)
-    y_pred = np.argmax(y_pred, 1)
+        # Update metrics using the top score
+        start = step * test_batch_size
+        metrics.update(np.argmax(y_true[start:start+len(x_batch)], 1), np.argmax(y_pred, 1))
 
-    print('Confusion matrix:\n', confusion_matrix(y_true, y_pred))
-    print('\nAccuracy: ', accuracy_score(y_true, y_pred))
-    print('Recall: ', recall_score(y_true, y_pred, average='weighted'))
-    print('Precision: ', precision_score(y_true, y_pred, average='weighted'))
-    print('F1-Score: ', f1_score(y_true, y_pred, average='weighted'))
+        # The decoder only runs for the samples that are shown
+        num_shown = 50 - len(x_shown)
+        if num_shown > 0:
+            _, x_recon = recon_model.predict_on_batch(x_batch[:num_shown])
+            x_shown.extend(x_batch[:num_shown])
+            x_recon_shown.extend(x_recon)
 
-    img = utils.combine_images(np.concatenate([x_augmented[:50], x_recon[:50]]))
-    image = img * 255
+    # Print different metrics
+    metrics.print_report()
+
+    img = utils.combine_images(np.concatenate([x_shown, x_recon_shown]))
 
     print('\nReconstructed images are saved to %s/real_and_recon.png' % args.save_dir)
-    Image.fromarray(image.astype(np.uint8)).save(args.save_dir + "/real_and_recon.png")
-    plt.imshow(plt.imread(args.save_dir + "/real_and_recon.png"))
-    plt.show()
+    writer.save_image(img, "real_and_recon.png")
+    if not args.headless:
+        plt.imshow(img, cmap='gray')
+        plt.show()
 
 
-def manipulate_latent(model, data, args):
+def manipulate_latent(model, data, args, writer):
     x_true, y_true = data
 
     index = np.argmax(y_true, 1) == args.digit
@@ -216,8 +318,7 @@ def manipulate_latent(model, data, args):
     x_recons = np.concatenate(x_recons)
 
     img = utils.combine_images(x_recons, height=16)
-    image = img*255
-    Image.fromarray(image.astype(np.uint8)).save(args.save_dir + '/manipulate-%d.png' % args.digit)
+    writer.save_image(img, 'manipulate-%d.png' % args.digit)
     print('Manipulated result saved to %s/manipulate-%d.png' % (args.save_dir, args.digit))
 
 
@@ -230,6 +331,9 @@ if __name__ == "__main__":
 
     parser.add_argument('--batch_size', default=128, type=int)
 
+    parser.add_argument('--accumulate_steps', default=1, type=int,
+                        help="Number of batches whose gradients are summed before one Adam update. The effective batch size is batch_size * accumulate_steps")
+
     parser.add_argument('--max_num_samples', default=None, type=int,
                         help="Max. number of training examples to use. -1 to use all")
 
@@ -245,14 +349,47 @@ if __name__ == "__main__":
     parser.add_argument('-r', '--num_routing', default=3, type=int,
                         help="Number of iterations used in routing algorithm. should > 0")
 
+    parser.add_argument('--dense_decoder', action='store_true',
+                        help="Use the flattened Mask and a Dense first decoder layer instead of the class conditional one. Both share the same weights")
+
+    parser.add_argument('--recompute_routing', action='store_true',
+                        help="Recompute the routing iterations in the backward pass instead of storing them. Saves memory for larger num_routing")
+
     parser.add_argument('--shift_fraction', default=0.1, type=float,
                         help="Fraction of pixels to shift at most in each direction.")
 
     parser.add_argument('--debug', action='store_true',
                         help="Save weights by TensorBoard")
 
+    parser.add_argument('--profile_memory', action='store_true',
+                        help="Write the largest tensors and the peak RSS of every epoch into save_dir/memory_report.txt")
+
+    parser.add_argument('--trace_steps', default=None,
+                        help="Capture a TF timeline of the training steps START:END (END excluded) into save_dir")
+
+    parser.add_argument('--routing_log_freq', default=0, type=int,
+                        help="Log routing statistics to TensorBoard every N training steps. 0 disables it.")
+
+    parser.add_argument('--intra_op_threads', default=0, type=int,
+                        help="Threads used inside of one op. 0 uses one thread per available core. Without any of these flags TF keeps its defaults")
+
+    parser.add_argument('--inter_op_threads', default=0, type=int,
+                        help="Number of ops run in parallel. 0 uses the TF default")
+
+    parser.add_argument('--cpus', default=None,
+                        help="Pin the process to these cores, e.g. 0-7,16-23. Use it to run several jobs on one host")
+
+    parser.add_argument('--numa_node', default=None, type=int,
+                        help="Pin the process to the cores (and thereby the memory) of this NUMA node")
+
+    parser.add_argument('--autotune_threads', action='store_true',
+                        help="Time a few training steps for a small grid of thread settings and train with the fastest")
+
     parser.add_argument('--save_dir', default='./result-capsnet')
 
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue the training from save_dir/checkpoint.hdf5 (weights, optimizer state and epoch)")
+
     parser.add_argument('-t', '--testing', action='store_true',
                         help="Test the trained model on testing dataset")
     
@@ -262,8 +399,33 @@ if __name__ == "__main__":
     parser.add_argument('--digit', default=5, type=int,
                         help="Digit to manipulate")
 
+    parser.add_argument('--headless', action='store_true',
+                        help="Do not show any image or plot. Plots are saved into save_dir instead.")
+
+    parser.add_argument('--export_routing', default=None,
+                        help="Export the coupling coefficients c_ij and b_ij of the whole split into the given HDF5 file. So provide weights via -w.")
+
+    parser.add_argument('--export_split', default='test', choices=['test', 'train'],
+                        help="Split used by --export_routing")
+
+    parser.add_argument('--freeze', default=None,
+                        help="Write the inference graph (eval_model) with folded weights into the given file. Run it with freeze.FrozenModel. So provide weights via -w.")
+
+    parser.add_argument('--quantize', default=None,
+                        help="Compress conv kernels and W of the classification model to int8, save them into the given npz file and compare accuracy and size with float32. The weights are dequantized at load time, inference is not faster. So provide weights via -w.")
+
+    parser.add_argument('--calibration_samples', default=300, type=int,
+                        help="Number of training images used to calibrate --quantize")
+
     parser.add_argument('-w', '--weights', default=None,
-                        help="The path of the saved weights. Should be specified when testing")
+                        help="The path of the saved weights (HDF5 or .mmw). Should be specified when testing")
     args = parser.parse_args()
+    if args.trace_steps is not None:
+        try:
+            monitor.parse_step_window(args.trace_steps)
+        except ValueError as e:
+            parser.error("--trace_steps: %s" % e)
+    if args.accumulate_steps < 1:
+        parser.error("--accumulate_steps must be at least 1")
 
     main(args)
\ No newline at end of file
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import struct
+import argparse
+import h5py
+import numpy as np
+
+from keras import backend as K
+
+
+MAGIC = b'CAPSMMW1'
+ALIGNMENT = 4096
+
+
+def save_weights(weights, path):
+    """ Write weights into a .mmw file: the magic, the header length, a JSON header with layer, name,
+        dtype, shape and offset of every variable and one raw C-order buffer per variable. Every
+        buffer starts at a page boundary, so it can be memory-mapped and used without a copy.
+
+        :param weights: List of (layer_name, weight_name, array) in the order of the model
+        :return Path of the file
+    """
+    entries, offset = [], 0
+    for layer_name, weight_name, value in weights:
+        value = np.ascontiguousarray(value)
+        entries.append(dict(layer=layer_name, name=weight_name, dtype=value.dtype.str,
+                            shape=list(value.shape), offset=offset, nbytes=value.nbytes))
+        offset = _align(offset + value.nbytes)
+
+    header = json.dumps(entries).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    # Written into a temporary file, so a running process never maps a partial file
+    with open(path + '.tmp', 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for entry, (_, _, value) in zip(entries, weights):
+            f.seek(data_start + entry['offset'])
+            f.write(np.ascontiguousarray(value).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def convert(hdf5_path, path):
+    """ Convert a weights file of model.save_weights (or a checkpoint of AsyncCheckpoint) into a
+        .mmw file. The model code is not needed, optimizer weights are dropped.
+    """
+    weights = []
+    with h5py.File(hdf5_path, 'r') as f:
+        if 'layer_names' not in f.attrs and 'model_weights' in f:
+            f = f['model_weights']
+        for layer_name in _decode(f.attrs['layer_names']):
+            group = f[layer_name]
+            for weight_name in _decode(group.attrs['weight_names']):
+                weights.append((layer_name, weight_name, group[weight_name][()]))
+    return save_weights(weights, path)
+
+
+def open_weights(path):
+    """ Memory-map a .mmw file.
+
+        :return Dict layer_name -> list of read-only arrays that share the pages of the file, in the order of the file
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a .mmw weights file" % path)
+        header_length, = struct.unpack('<Q', f.read(8))
+        entries = json.loads(f.read(header_length).decode('utf-8'))
+
+    data_start = _align(len(MAGIC) + 8 + header_length)
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    weights = {}
+    for entry in entries:
+        start = data_start + entry['offset']
+        value = buffer[start:start + entry['nbytes']].view(np.dtype(entry['dtype'])).reshape(entry['shape'])
+        weights.setdefault(entry['layer'], []).append(value)
+    return weights
+
+
+def load_weights(model, path):
+    """ Assign the weights of a .mmw file to the layers of model with the same name. If the names do
+        not match (e.g. auto-generated names of an older model) the layers with weights are matched
+        in order, like keras load_weights does. The values are read from the mapped pages by the
+        assign ops, there is no parse or copy in Python. Processes that load the same file share
+        its pages in the page cache.
+    """
+    weights = open_weights(path)
+    layers = [layer for layer in model.layers if layer.weights]
+    if all(layer.name in weights for layer in layers):
+        pairs = [(layer, weights[layer.name]) for layer in layers]
+    elif len(layers) == len(weights):
+        pairs = list(zip(layers, weights.values()))
+    else:
+        raise ValueError("The layer names of %s do not match and it contains %d layers with weights, the model has %d"
+                         % (path, len(weights), len(layers)))
+
+    assignments = []
+    for layer, values in pairs:
+        if len(values) != len(layer.weights):
+            raise ValueError("Layer %s expects %d weights, %s contains %d" % (layer.name, len(layer.weights), path, len(values)))
+        for variable, value in zip(layer.weights, values):
+            if K.int_shape(variable) != value.shape:
+                raise ValueError("Weight %s has shape %s, %s contains %s" % (variable.name, K.int_shape(variable), path, value.shape))
+            assignments.append((variable, value))
+    K.batch_set_value(assignments)
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _decode(names):
+    return [n.decode('utf8') if isinstance(n, bytes) else n for n in names]
+
+
+#
+# Main
+#
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a Keras HDF5 weights file into a memory-mapped .mmw file.")
+    parser.add_argument('hdf5',
+                        help="Weights file written by save_weights or a checkpoint")
+
+    parser.add_argument('mmw', nargs='?', default=None,
+                        help="Output file. Default is the input with the extension .mmw")
+    args = parser.parse_args()
+
+    path = args.mmw or os.path.splitext(args.hdf5)[0] + '.mmw'
+    start = time.perf_counter()
+    convert(args.hdf5, path)
+    print("Converted %s (%.1f MB) to %s (%.1f MB) in %.1f s" % (args.hdf5, os.path.getsize(args.hdf5) / 2.**20, path,
+          os.path.getsize(path) / 2.**20, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    weights = open_weights(path)
+    print("Mapped %d arrays in %.2f ms" % (sum(len(w) for w in weights.values()), (time.perf_counter() - start) * 1000))
@@ -0,0 +1,75 @@
+import os
+import argparse
+
+
+def pin(intra_op_threads=0, cpus=None, numa_node=None):
+    """ Pin the process to the given cores and set the thread count of the MKL / OpenMP pools.
+        OpenMP and MKL read the variables when TF is loaded, so this has to run before tensorflow
+        or keras is imported. Memory is allocated on first touch, so pinning to the cores of one
+        NUMA node also keeps the weights and activations on that node.
+
+        :param intra_op_threads: Threads of the pools. 0 uses one per available core
+        :param cpus: Cores to pin the process to, e.g. "0-7,16-23"
+        :param numa_node: Pin the process to the cores of this NUMA node
+        :return Dict with the applied configuration
+    """
+    if numa_node is not None:
+        cpus = _read_cpulist('/sys/devices/system/node/node%d/cpulist' % numa_node)
+    elif cpus is not None:
+        cpus = parse_cpulist(cpus)
+
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+        os.environ['KMP_AFFINITY'] = 'granularity=fine,compact,1,0'
+
+    intra_op_threads = intra_op_threads or len(os.sched_getaffinity(0))
+    os.environ['OMP_NUM_THREADS'] = str(intra_op_threads)
+    os.environ['MKL_NUM_THREADS'] = str(intra_op_threads)
+    return dict(intra_op_threads=intra_op_threads, cpus=format_cpulist(sorted(os.sched_getaffinity(0))))
+
+
+def pin_from_argv(argv):
+    """ Read --intra_op_threads, --cpus and --numa_node ahead of the parser of the script and pin
+        the process, so it happens before keras is imported. Nothing is changed without these flags.
+
+        :return Dict with the applied configuration or None
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--intra_op_threads', default=0, type=int)
+    parser.add_argument('--cpus', default=None)
+    parser.add_argument('--numa_node', default=None, type=int)
+    args, _ = parser.parse_known_args(argv)
+    if not args.intra_op_threads and args.cpus is None and args.numa_node is None:
+        return None
+    return pin(args.intra_op_threads, args.cpus, args.numa_node)
+
+
+def parse_cpulist(cpulist):
+    """ "0-3,8" -> [0, 1, 2, 3, 8]
+    """
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    """ [0, 1, 2, 3, 8] -> "0-3,8"
+    """
+    parts, start = [], None
+    for i, cpu in enumerate(cpus):
+        if start is None:
+            start = cpu
+        if i + 1 == len(cpus) or cpus[i + 1] != cpu + 1:
+            parts.append(str(start) if start == cpu else "%d-%d" % (start, cpu))
+            start = None
+    return ','.join(parts)
+
+
+def _read_cpulist(path):
+    with open(path) as f:
+        return parse_cpulist(f.read())
@@ -0,0 +1,248 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+
+#
+# Set defaults
+#
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = {
+    'mnist':            'capsnet.py',
+    'cifar10':          'capsnet.py',
+    'symmetric_forms':  'main.py',
+}
+DEFAULT_SPACE = {
+    'lr':                           {'min': 0.0001, 'max': 0.01, 'log': True},
+    'lr_decay':                     {'min': 0.8, 'max': 0.99},
+    'num_routing':                  [1, 2, 3],
+    'scale_reconstruction_loss':    {'min': 0.0001, 'max': 0.005, 'log': True},
+    'shift_fraction':               [0.0, 0.1, 0.2],
+}
+
+
+#
+# Main
+#
+def main(args):
+    """ Random search with asynchronous successive halving. Up to --parallel trials run at the same
+        time, each as its own capsnet.py process with a fixed number of threads (and optionally its
+        own cores). A trial that finishes a rung epoch (min_epochs * eta^k) with a val_capsnet_acc
+        below the top 1/eta of all trials that reached this rung is stopped, so its slot is free
+        for the next trial. Trials never wait for each other.
+    """
+    space = DEFAULT_SPACE
+    if args.space is not None:
+        with open(args.space) as f:
+            space = json.load(f)
+
+    if not os.path.exists(args.sweep_dir):
+        os.makedirs(args.sweep_dir)
+
+    rng = np.random.RandomState(args.seed)
+    trials = [dict(id=i, params=sample(space, rng), status='pending') for i in range(args.num_trials)]
+    rungs = rung_epochs(args.min_epochs, args.max_epochs, args.eta)
+    rung_results = {r: {} for r in rungs}
+    print("Rungs at epochs %s, %d trials, %d in parallel" % (rungs, len(trials), args.parallel))
+
+    free_slots = list(range(args.parallel))
+    running = []
+    pending = list(trials)
+    while pending or running:
+        while pending and free_slots:
+            trial = pending.pop(0)
+            start_trial(trial, free_slots.pop(0), args)
+            running.append(trial)
+
+        time.sleep(args.poll_interval)
+        for trial in list(running):
+            history = read_history(trial['log'])
+            trial['epochs'] = len(history)
+            trial['history'] = history
+
+            # Check every rung that was passed since the last poll
+            for epoch, acc in enumerate(history, 1):
+                if epoch in rung_results and trial['id'] not in rung_results[epoch]:
+                    rung_results[epoch][trial['id']] = acc
+                    if not promote(acc, list(rung_results[epoch].values()), args.eta):
+                        trial['process'].terminate()
+                        trial['status'] = 'stopped'
+                        print("Trial %d stopped at epoch %d (val_capsnet_acc %.4f)" % (trial['id'], epoch, acc))
+                        break
+
+            returncode = trial['process'].poll()
+            if trial['status'] == 'stopped' or returncode is not None:
+                trial['process'].wait()
+                trial['output'].close()
+                if trial['status'] == 'running':
+                    trial['status'] = 'done' if returncode == 0 else 'failed'
+                trial['time'] = time.time() - trial['start']
+                trial['history'] = read_history(trial['log'])
+                trial['epochs'] = len(trial['history'])
+                print("Trial %d %s after %d epochs" % (trial['id'], trial['status'], trial['epochs']))
+                running.remove(trial)
+                free_slots.append(trial['slot'])
+
+    rows = aggregate(trials, space)
+    save_table(rows, os.path.join(args.sweep_dir, 'results.csv'))
+    print_table(rows, space)
+    print("Sweep results saved to %s" % os.path.join(args.sweep_dir, 'results.csv'))
+
+
+def sample(space, rng):
+    """ Draw one configuration. A list is a choice, a dict with min and max a uniform
+        (or with "log": true a log-uniform) range.
+    """
+    params = {}
+    for name in sorted(space):
+        values = space[name]
+        if isinstance(values, list):
+            params[name] = values[rng.randint(len(values))]
+        elif values.get('log', False):
+            params[name] = float(np.exp(rng.uniform(np.log(values['min']), np.log(values['max']))))
+        else:
+            params[name] = float(rng.uniform(values['min'], values['max']))
+    return params
+
+
+def rung_epochs(min_epochs, max_epochs, eta):
+    """ Epochs after which the trials are compared, e.g. [1, 3, 9] for min_epochs=1, max_epochs=10, eta=3
+    """
+    rungs, epoch = [], min_epochs
+    while epoch < max_epochs:
+        rungs.append(epoch)
+        epoch *= eta
+    return rungs
+
+
+def promote(acc, rung_accs, eta):
+    """ Keep a trial if it is within the top 1/eta of all trials that reached the rung so far.
+        The first eta - 1 trials of a rung are always kept, there is nothing to compare them with.
+    """
+    if len(rung_accs) < eta:
+        return True
+    k = len(rung_accs) // eta
+    return acc >= sorted(rung_accs, reverse=True)[k - 1]
+
+
+def start_trial(trial, slot, args):
+    save_dir = os.path.abspath(os.path.join(args.sweep_dir, 'trial-%03d' % trial['id']))
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    cmd = [sys.executable, SCRIPTS[args.dataset],
+           '--save_dir', save_dir,
+           '--epochs', str(args.max_epochs),
+           '--headless',
+           '--intra_op_threads', str(args.threads),
+           '--inter_op_threads', '1']
+    # Disjoint cores per slot, so parallel trials do not compete for the same caches
+    if args.pin:
+        first = slot * args.threads
+        cmd += ['--cpus', '%d-%d' % (first, first + args.threads - 1)]
+    for name, value in sorted(trial['params'].items()):
+        cmd += ['--' + name, str(value)]
+    cmd += args.extra
+
+    trial.update(slot=slot, save_dir=save_dir, log=os.path.join(save_dir, 'log.csv'), status='running',
+                 start=time.time(), epochs=0, history=[])
+    trial['output'] = open(os.path.join(save_dir, 'output.txt'), 'w')
+    trial['process'] = subprocess.Popen(cmd, cwd=os.path.join(ROOT_DIR, args.dataset),
+                                        stdout=trial['output'], stderr=subprocess.STDOUT)
+    print("Trial %d started in slot %d: %s" % (trial['id'], slot, ' '.join(cmd[2:])))
+
+
+def read_history(path, monitor='val_capsnet_acc'):
+    """ :return val_capsnet_acc of every finished epoch in log.csv
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [float(row[monitor]) for row in csv.DictReader(f) if row.get(monitor)]
+
+
+def aggregate(trials, space):
+    rows = []
+    for trial in trials:
+        history = trial.get('history', [])
+        row = dict(trial=trial['id'], status=trial['status'], epochs=len(history),
+                   best_val_capsnet_acc=max(history) if history else float('nan'),
+                   last_val_capsnet_acc=history[-1] if history else float('nan'),
+                   time_sec=trial.get('time', float('nan')))
+        row.update(trial['params'])
+        rows.append(row)
+    # Trials without a finished epoch last
+    return sorted(rows, key=lambda r: -r['best_val_capsnet_acc'] if r['epochs'] else 1.)
+
+
+def save_table(rows, filename):
+    if not rows:
+        return
+    with open(filename, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def print_table(rows, space):
+    names = sorted(space)
+    print("\n%5s %-8s %6s %10s %10s %9s " % ("trial", "status", "epochs", "best acc", "last acc", "time [s]") +
+          " ".join("%14s" % n[:14] for n in names))
+    for r in rows:
+        print("%5d %-8s %6d %10.4f %10.4f %9.0f " % (r['trial'], r['status'], r['epochs'], r['best_val_capsnet_acc'],
+                                                     r['last_val_capsnet_acc'], r['time_sec']) +
+              " ".join("%14s" % ("%.6g" % r[n] if isinstance(r[n], float) else r[n]) for n in names))
+
+
+#
+# Main
+#
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep of a CapsNet with asynchronous successive halving. "
+                                                 "Arguments after -- are passed to every trial.")
+    parser.add_argument('--dataset', default='cifar10', choices=sorted(SCRIPTS.keys()))
+
+    parser.add_argument('--space', default=None,
+                        help="JSON file with the search space, e.g. {\"lr\": {\"min\": 0.0001, \"max\": 0.01, \"log\": true}, \"num_routing\": [1, 3]}. "
+                             "Default tunes lr, lr_decay, num_routing, scale_reconstruction_loss and shift_fraction")
+
+    parser.add_argument('--num_trials', default=27, type=int,
+                        help="Number of sampled configurations")
+
+    parser.add_argument('--parallel', default=2, type=int,
+                        help="Number of trials that run at the same time")
+
+    parser.add_argument('--threads', default=4, type=int,
+                        help="intra_op_threads of every trial. parallel * threads should not exceed the cores")
+
+    parser.add_argument('--pin', action='store_true',
+                        help="Pin every trial to its own --threads cores")
+
+    parser.add_argument('--min_epochs', default=1, type=int,
+                        help="First rung of the successive halving")
+
+    parser.add_argument('--max_epochs', default=27, type=int,
+                        help="Epochs of a trial that is never stopped")
+
+    parser.add_argument('--eta', default=3, type=int,
+                        help="Only the top 1/eta of the trials at a rung continue. The next rung is eta times later")
+
+    parser.add_argument('--poll_interval', default=10., type=float,
+                        help="Seconds between two reads of the log.csv files")
+
+    parser.add_argument('--seed', default=0, type=int)
+
+    parser.add_argument('--sweep_dir', default='./result-sweep',
+                        help="One sub directory per trial and results.csv")
+
+    argv = sys.argv[1:]
+    extra = argv[argv.index('--') + 1:] if '--' in argv else []
+    args = parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+    args.extra = extra
+
+    main(args)
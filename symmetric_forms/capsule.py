@@ -1,14 +1,22 @@
-from keras import layers, initializers
+from keras import layers, initializers, activations
 import keras.backend as K
 from keras.engine.topology import Layer
 import tensorflow as tf
 
 
 class CapsuleLayer(Layer):
-    def __init__(self, num_capsule, dim_vector, num_routing, **kwargs):
+    def __init__(self, num_capsule, dim_vector, num_routing, return_routing=False, recompute_routing=False, **kwargs):
+        """ :param return_routing: If True the layer additionally outputs the final coupling
+                                   coefficients c_ij and log priors b_ij, each of shape
+                                   (None, num_capsule, input_num_capsule)
+            :param recompute_routing: If True the routing iterations are computed again in the backward
+                                      pass instead of keeping c_ij, s_j, v_j and b_ij of every iteration
+        """
         self.num_capsule = num_capsule
         self.dim_vector = dim_vector
         self.num_routing = num_routing
+        self.return_routing = return_routing
+        self.recompute_routing = recompute_routing
         self.kernel_initializer = initializers.get('glorot_uniform')
 
         super(CapsuleLayer, self).__init__(**kwargs)
@@ -39,36 +47,111 @@ class CapsuleLayer(Layer):
 
 
     def call(self, u, training = False):
+        u_hat = self.predict_vectors(u)
+        if self.recompute_routing and not self.return_routing:
+            return self.route_recompute(u_hat)
+
+        v_j, c_ij, b_ij = self.route(u_hat)
+
+        if self.return_routing:
+            return [v_j, c_ij, b_ij]
+        return v_j
+
+
+    def predict_vectors(self, u):
+        """ Compute the prediction vectors u_hat = W * u of all input capsules for all output capsules.
+
+            :param u: (None, input_num_capsule, input_dim_vector)
+            :return u_hat of shape (None, num_capsule, input_num_capsule, dim_vector)
+        """
         batch_size = tf.shape(u)[0]
         
         # First of all we add one dimension to the input and duplicate it num_capsule times to get the output of the
         # previous layer as input for every capsule of the following layer.
         # Output shape = (batch_size, num_capsule, input_num_capsule, input_dim)
-        u_expand = K.expand_dims(u, 1)
-        u_tiled = K.tile(u_expand, [1, self.num_capsule, 1, 1])
+        with tf.name_scope('u_tiled'):
+            u_expand = K.expand_dims(u, 1)
+            u_tiled = K.tile(u_expand, [1, self.num_capsule, 1, 1])
 
         # Now we want to weight the input via u*W
         # So we expand and tile our weight matrix W into the batch_size dimension 
         # such that we are able to multiply W with u_hat
         # Note: This is much faster than k.map_fn
-        W_tiled = K.tile(self.W, [batch_size, 1, 1, 1, 1])
-        u_hat = K.batch_dot(u_tiled, W_tiled, [3,4])
+        with tf.name_scope('W_tiled'):
+            W_tiled = K.tile(self.W, [batch_size, 1, 1, 1, 1])
+        with tf.name_scope('u_hat'):
+            u_hat = K.batch_dot(u_tiled, W_tiled, [3,4])
+
+        return u_hat
 
-        # Initialize the log prior probabilities with zero
-        b_ij = tf.zeros(shape=[K.shape(u_hat)[0], self.num_capsule, self.input_num_capsule])
 
+    def route(self, u_hat, trace=None):
+        """ Dynamic routing between the prediction vectors u_hat and the output capsules.
+
+            :param u_hat: (None, num_capsule, input_num_capsule, dim_vector)
+            :param trace: If a list is given, the tuple (c_ij, v_j) of every iteration is appended
+            :return v_j, c_ij and b_ij of the last iteration
+        """
         # Start with the dynamic routing algorithm
         for i in range(self.num_routing):
-            c_ij = tf.nn.softmax(b_ij, dim=1)
-            s_j = K.batch_dot(c_ij, u_hat, [2, 2])
-            v_j = squashing(s_j)
-            b_ij += K.batch_dot(v_j, u_hat, [2, 3])
+            with tf.name_scope('routing_%d' % i):
+                if i == 0:
+                    # The log prior probabilities start with zero, so the first coupling coefficients
+                    # are uniform (1 / num_capsule) and s_j is the scaled sum of u_hat. c_ij is only computed if fetched
+                    c_ij = tf.fill(tf.shape(u_hat)[:3], 1. / self.num_capsule)
+                    s_j = K.sum(u_hat, axis=2) / self.num_capsule
+                    v_j = squashing(s_j)
+                    b_ij = K.batch_dot(v_j, u_hat, [2, 3])
+                else:
+                    c_ij = tf.nn.softmax(b_ij, dim=1)
+                    s_j = K.batch_dot(c_ij, u_hat, [2, 2])
+                    v_j = squashing(s_j)
+                    b_ij += K.batch_dot(v_j, u_hat, [2, 3])
+
+            if trace is not None:
+                trace.append((c_ij, v_j))
+
+        return v_j, c_ij, b_ij
+
+
+    def route_recompute(self, u_hat):
+        """ Same as route, but only u_hat and v_j are kept for the backward pass. The gradient
+            runs the routing again on u_hat, which costs one more forward pass of the routing
+            but the memory does not grow with num_routing anymore.
+
+            :param u_hat: (None, num_capsule, input_num_capsule, dim_vector)
+            :return v_j of the last iteration
+        """
+        @tf.custom_gradient
+        def routing(u_hat):
+            v_j, _, _ = self.route(u_hat)
 
-        return v_j
+            def grad(dv_j):
+                # Otherwise the recomputation could already be scheduled during the forward pass
+                with tf.control_dependencies([dv_j]):
+                    u_hat_recompute = tf.identity(u_hat)
+
+                with tf.name_scope('routing_recompute'):
+                    v_j_recompute, _, _ = self.route(u_hat_recompute)
+                return tf.gradients(v_j_recompute, u_hat_recompute, grad_ys=dv_j)[0]
+
+            return v_j, grad
+
+        return routing(u_hat)
 
 
     def compute_output_shape(self, input_shape):
-        return (input_shape[0], self.num_capsule, self.dim_vector)
+        output_shape = (input_shape[0], self.num_capsule, self.dim_vector)
+        if self.return_routing:
+            routing_shape = (input_shape[0], self.num_capsule, input_shape[1])
+            return [output_shape, routing_shape, routing_shape]
+        return output_shape
+
+
+    def compute_mask(self, inputs, mask=None):
+        if self.return_routing:
+            return [None, None, None]
+        return None
 
 
 
@@ -98,7 +181,7 @@ def PrimaryCaps(layer_input, name, dim_capsule, channels, kernel_size=9, strides
     reshaped_conv = layers.Reshape(target_shape=(-1, dim_capsule))(conv_layer)
 
     # Now lets apply the squashing function
-    return layers.Lambda(squashing)(reshaped_conv)
+    return layers.Lambda(squashing, name=name + '_squash')(reshaped_conv)
 
 
 def squashing(vectors, axis=-1):
@@ -170,7 +253,13 @@ class Mask(layers.Layer):
         # or
         out2 = Mask()([x, y])  # out2.shape=[8,6]. Masked with true labels y. Of course y can also be manipulated.
         ```
+    With gather=True only the selected capsule is returned together with its class index as last
+    element, e.g. out.shape=[8, 3]. This is the input of ClassConditionalDense.
     """
+    def __init__(self, gather=False, **kwargs):
+        super(Mask, self).__init__(**kwargs)
+        self.gather = gather
+
     def call(self, inputs, **kwargs):
         if type(inputs) is list:  # true label is provided with shape = [None, n_classes], i.e. one-hot code.
             assert len(inputs) == 2
@@ -182,6 +271,14 @@ class Mask(layers.Layer):
             # mask.shape=[None, n_classes]=[None, num_capsule]
             mask = K.one_hot(indices=K.argmax(x, 1), num_classes=x.get_shape().as_list()[1])
 
+        if self.gather:
+            # selected.shape=[None, dim_capsule]
+            # output.shape=[None, dim_capsule + 1]
+            index = K.argmax(mask, 1)
+            batch_index = tf.range(tf.shape(inputs)[0], dtype=index.dtype)
+            selected = tf.gather_nd(inputs, K.stack([batch_index, index], axis=1))
+            return K.concatenate([selected, K.expand_dims(K.cast(index, K.floatx()), -1)], axis=-1)
+
         # inputs.shape=[None, num_capsule, dim_capsule]
         # mask.shape=[None, num_capsule]
         # masked.shape=[None, num_capsule * dim_capsule]
@@ -190,6 +287,62 @@ class Mask(layers.Layer):
 
     def compute_output_shape(self, input_shape):
         if type(input_shape[0]) is tuple:  # true label provided
-            return tuple([None, input_shape[0][1] * input_shape[0][2]])
-        else:  # no true label provided
-            return tuple([None, input_shape[1] * input_shape[2]])
\ No newline at end of file
+            input_shape = input_shape[0]
+
+        if self.gather:
+            return tuple([None, input_shape[2] + 1])
+        return tuple([None, input_shape[1] * input_shape[2]])
+
+    def get_config(self):
+        config = {'gather': self.gather}
+        base_config = super(Mask, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class ClassConditionalDense(layers.Layer):
+    """ First decoder layer for the output of Mask(gather=True). A Dense layer on the flattened output
+        of Mask() only sees dim_capsule non-zero inputs, so we multiply the selected capsule only with
+        the kernel rows of its class. The result is the same, but it needs n_class times fewer FLOPs.
+        The kernel has the shape of the Dense layer, so weights of both can be exchanged.
+
+        inputs: shape=[None, dim_capsule + 1], the selected capsule and its class index
+        output: shape=[None, units]
+    """
+    def __init__(self, units, n_class, activation=None, **kwargs):
+        super(ClassConditionalDense, self).__init__(**kwargs)
+        self.units = units
+        self.n_class = n_class
+        self.activation = activations.get(activation)
+
+    def build(self, input_shape):
+        self.dim_capsule = input_shape[-1] - 1
+        self.kernel = self.add_weight(name='kernel',
+                                      shape=(self.n_class * self.dim_capsule, self.units),
+                                      initializer='glorot_uniform',
+                                      trainable=True)
+        self.bias = self.add_weight(name='bias',
+                                    shape=(self.units,),
+                                    initializer='zeros',
+                                    trainable=True)
+        super(ClassConditionalDense, self).build(input_shape)
+
+    def call(self, inputs, **kwargs):
+        vectors = inputs[:, :-1]
+        index = K.cast(inputs[:, -1], 'int32')
+
+        # Rows j * dim_capsule ... (j + 1) * dim_capsule - 1 belong to class j
+        # kernel_j.shape=[None, dim_capsule, units]
+        kernel = K.reshape(self.kernel, (self.n_class, self.dim_capsule, self.units))
+        kernel_j = K.gather(kernel, index)
+        output = K.batch_dot(vectors, kernel_j, axes=[1, 1])
+        return self.activation(K.bias_add(output, self.bias))
+
+    def compute_output_shape(self, input_shape):
+        return tuple([input_shape[0], self.units])
+
+    def get_config(self):
+        config = {'units': self.units,
+                  'n_class': self.n_class,
+                  'activation': activations.serialize(self.activation)}
+        base_config = super(ClassConditionalDense, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
\ No newline at end of file
@@ -0,0 +1,135 @@
+import os
+import sys
+import h5py
+import queue
+import threading
+import numpy as np
+
+import keras
+from keras import callbacks
+from keras import backend as K
+
+
+class AsyncCheckpoint(callbacks.Callback):
+    """ Save the weights, the optimizer state and the epoch after every epoch without blocking the
+        training. The values are copied into memory at the end of the epoch and written by a
+        background thread into a temporary file that replaces the checkpoint when it is complete,
+        so a killed run always leaves the last complete checkpoint behind. The weights are stored
+        in the layout of model.save_weights, so model.load_weights can read every checkpoint.
+
+        Training only waits if the previous checkpoint is still being written at the end of the next epoch.
+
+        :param path: Checkpoint of the last epoch, used by restore
+        :param best_path: Optional checkpoint of the best epoch (instead of ModelCheckpoint), e.g. weights-{epoch:02d}.hdf5
+        :param monitor: Quantity for best_path, larger is better
+        :param save_best_only: If False best_path is written after every epoch
+        :param period: Epochs between two checkpoints
+    """
+    def __init__(self, path, best_path=None, monitor='val_capsnet_acc', save_best_only=True, period=1):
+        super(AsyncCheckpoint, self).__init__()
+        self.path = path
+        self.best_path = best_path
+        self.monitor = monitor
+        self.save_best_only = save_best_only
+        self.period = period
+        self.best = -np.inf
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = None
+        self.error = None
+
+    def restore(self, model):
+        """ Load weights, optimizer state and best value of the checkpoint into a compiled model.
+
+            :return Number of finished epochs, i.e. initial_epoch of fit. 0 if there is no checkpoint
+        """
+        if not os.path.exists(self.path):
+            print("No checkpoint %s found, starting from epoch 0" % self.path)
+            return 0
+
+        model.load_weights(self.path)
+        with h5py.File(self.path, 'r') as f:
+            epoch = int(f.attrs['epoch'])
+            self.best = float(f.attrs['best'])
+            if 'optimizer_weights' in f:
+                group = f['optimizer_weights']
+                values = [group[n][()] for n in _decode(group.attrs['weight_names'])]
+                # The optimizer weights are created with the train function
+                model._make_train_function()
+                model.optimizer.set_weights(values)
+        print("Resuming from %s after epoch %d" % (self.path, epoch))
+        return epoch
+
+    def on_train_begin(self, logs=None):
+        self.thread = threading.Thread(target=self._write_loop, name='checkpoint')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.error is not None:
+            raise self.error
+        if (epoch + 1) % self.period != 0:
+            return
+
+        paths = [self.path]
+        current = (logs or {}).get(self.monitor)
+        if current is not None and current > self.best:
+            self.best = current
+            if self.best_path is not None:
+                paths.append(self.best_path.format(epoch=epoch + 1, **logs))
+                print("\n%s improved to %.4f, saving model to %s" % (self.monitor, current, paths[-1]))
+        elif self.best_path is not None and not self.save_best_only:
+            paths.append(self.best_path.format(epoch=epoch + 1, **(logs or {})))
+
+        # Copy everything now, the training changes the variables while the thread writes
+        layers = [(layer.name, [w.name for w in layer.weights], K.batch_get_value(layer.weights))
+                  for layer in self.model.layers]
+        optimizer_weights = getattr(self.model.optimizer, 'weights', [])
+        optimizer = ([w.name for w in optimizer_weights], K.batch_get_value(optimizer_weights))
+        self.queue.put((paths, epoch + 1, self.best, layers, optimizer))
+
+    def on_train_end(self, logs=None):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                paths, epoch, best, layers, optimizer = item
+                for path in paths:
+                    _write_atomic(path, epoch, best, layers, optimizer)
+            except Exception as e:
+                print("Checkpoint could not be written: %s" % e, file=sys.stderr)
+                self.error = e
+
+
+def _write_atomic(path, epoch, best, layers, optimizer):
+    tmp_path = path + '.tmp'
+    with h5py.File(tmp_path, 'w') as f:
+        # Same layout as keras.engine.saving.save_weights_to_hdf5_group
+        f.attrs['layer_names'] = [name.encode('utf8') for name, _, _ in layers]
+        f.attrs['backend'] = K.backend().encode('utf8')
+        f.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+        f.attrs['epoch'] = epoch
+        f.attrs['best'] = best
+        for name, weight_names, values in layers:
+            _write_group(f.create_group(name), weight_names, values)
+        _write_group(f.create_group('optimizer_weights'), *optimizer)
+
+    with open(tmp_path, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _write_group(group, weight_names, values):
+    group.attrs['weight_names'] = [n.encode('utf8') for n in weight_names]
+    for name, value in zip(weight_names, values):
+        group.create_dataset(name, data=value)
+
+
+def _decode(names):
+    return [n.decode('utf8') if isinstance(n, bytes) else n for n in names]
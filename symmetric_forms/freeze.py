@@ -0,0 +1,121 @@
+import os
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import graph_util
+from tensorflow.python.tools import optimize_for_inference_lib
+from tensorflow.tools.graph_transforms import TransformGraph
+
+
+INPUT_NAMES = 'frozen_input_names'
+OUTPUT_NAMES = 'frozen_output_names'
+
+
+def freeze_model(model, path, session):
+    """ Write the inference graph of a Keras model into a single GraphDef file. The weights are
+        folded into constants and every node that is not needed for the outputs of model (training,
+        manipulate and fool branches, optimizer) is pruned and identity nodes are removed. Afterwards
+        every subgraph that only depends on constants is evaluated once and replaced by its result
+        (fold_constants). Ops that depend on the batch, e.g. the tiling of W and the routing
+        iterations, stay in the graph. The learning phase must be set to 0 before the model is built.
+
+        :param model: Keras model, e.g. eval_model
+        :param path: Path of the artifact, e.g. frozen_model.pb
+        :param session: Session with the trained weights, i.e. K.get_session()
+        :return Path of the artifact
+    """
+    input_names = [t.op.name for t in model.inputs]
+    output_names = [t.op.name for t in model.outputs]
+
+    graph_def = graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), output_names)
+    graph_def = graph_util.remove_training_nodes(graph_def, protected_nodes=output_names)
+    graph_def = optimize_for_inference_lib.optimize_for_inference(graph_def, input_names, output_names,
+                                                                  [t.dtype.as_datatype_enum for t in model.inputs])
+    # optimize_for_inference only strips nodes and folds batch norms, constants are folded here
+    graph_def = TransformGraph(graph_def, input_names, output_names,
+                               ['fold_constants(ignore_errors=true)', 'strip_unused_nodes'])
+
+    # Store the names of the inputs and outputs, so the loader does not need the model code
+    with tf.Graph().as_default() as names_graph:
+        tf.constant(','.join(input_names), name=INPUT_NAMES)
+        tf.constant(','.join(output_names), name=OUTPUT_NAMES)
+    graph_def.node.extend(names_graph.as_graph_def().node)
+
+    with tf.gfile.GFile(path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+    print("Frozen graph with %d nodes (%.1f MB) saved to %s" % (len(graph_def.node), os.path.getsize(path) / 2.**20, path))
+    return path
+
+
+class FrozenModel(object):
+    """ Run predictions from an artifact written by freeze_model. Only TensorFlow is needed.
+
+        :param path: Path of the artifact
+        :param intra_op_threads: Threads used inside of one op. 0 uses the TF default
+        :param inter_op_threads: Number of ops run in parallel. 0 uses the TF default
+    """
+    def __init__(self, path, intra_op_threads=0, inter_op_threads=0):
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                inter_op_parallelism_threads=inter_op_threads)
+        self.session = tf.Session(graph=self.graph, config=config)
+
+        input_names, output_names = self.session.run([INPUT_NAMES + ':0', OUTPUT_NAMES + ':0'])
+        self.inputs = [self.graph.get_tensor_by_name(n + ':0') for n in input_names.decode('utf-8').split(',')]
+        self.outputs = [self.graph.get_tensor_by_name(n + ':0') for n in output_names.decode('utf-8').split(',')]
+
+    def predict(self, x, outputs=None):
+        """ :param x: Input batch or list of input batches
+            :param outputs: Indices of the outputs to compute, e.g. [0] for the capsule lengths only.
+                            Only the subgraph of these outputs is executed. Default are all outputs
+            :return One array per output or the array if there is only one
+        """
+        inputs = x if type(x) is list else [x]
+        fetches = self.outputs if outputs is None else [self.outputs[i] for i in outputs]
+        result = self.session.run(fetches, feed_dict=dict(zip(self.inputs, inputs)))
+        return result if len(result) > 1 else result[0]
+
+    def close(self):
+        self.session.close()
+
+
+#
+# Main
+#
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load a frozen CapsNet and measure startup and batch latency on random inputs.")
+    parser.add_argument('path',
+                        help="Artifact written with --freeze")
+
+    parser.add_argument('--batch_size', default=100, type=int)
+
+    parser.add_argument('--repeats', default=20, type=int)
+
+    parser.add_argument('--classify_only', action='store_true',
+                        help="Only compute the capsule lengths (first output)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    model = FrozenModel(args.path)
+    print("Startup: %.1f ms" % ((time.perf_counter() - start) * 1000))
+
+    shape = [d if d is not None else args.batch_size for d in model.inputs[0].shape.as_list()]
+    x = np.random.rand(*shape).astype('float32')
+    outputs = [0] if args.classify_only else None
+    model.predict(x, outputs)
+
+    times = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        model.predict(x, outputs)
+        times.append(time.perf_counter() - start)
+    print("Batch of %d: %.2f ms (median)" % (args.batch_size, np.median(times) * 1000))
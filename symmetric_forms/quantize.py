@@ -0,0 +1,152 @@
+import os
+import json
+import numpy as np
+
+from keras import layers
+
+import utils
+from capsule import CapsuleLayer
+
+
+def quantizable_weights(model):
+    """ Return (layer_name, weight_index, axes) of all weights that are quantized. axes are the axes
+        that share one scale: conv kernels per output channel and W of CapsuleLayer per
+        transformation matrix W_ij.
+    """
+    weights = []
+    for layer in model.layers:
+        if isinstance(layer, layers.Conv2D):
+            weights.append((layer.name, 0, (0, 1, 2)))
+        elif isinstance(layer, CapsuleLayer):
+            weights.append((layer.name, 0, (0, 3, 4)))
+    return weights
+
+
+def quantize_per_channel(w, axes, percentile=100.):
+    """ Symmetric int8 quantization with one scale per channel. Values above the given percentile
+        of |w| per channel are clipped.
+
+        :return (q, scale) with w ~ q * scale, q of dtype int8 and scale broadcastable to w
+    """
+    if percentile < 100.:
+        max_abs = np.percentile(np.abs(w), percentile, axis=axes, keepdims=True)
+    else:
+        max_abs = np.max(np.abs(w), axis=axes, keepdims=True)
+    scale = (np.maximum(max_abs, 1e-12) / 127.).astype(np.float32)
+    q = np.clip(np.round(w / scale), -127, 127).astype(np.int8)
+    return q, scale
+
+
+def dequantize(q, scale):
+    return q.astype(np.float32) * scale
+
+
+def calibrate(model, x, percentiles=(100., 99.99, 99.9, 99.5), batch_size=100):
+    """ Choose the clip percentile of every quantized weight that keeps the outputs of model on the
+        calibration images x closest to the float32 outputs. Layers are calibrated one after the
+        other on top of the already quantized layers. The float32 weights are restored afterwards.
+
+        :return Dict layer_name -> percentile
+    """
+    reference = model.predict(x, batch_size=batch_size)
+    float_weights = model.get_weights()
+
+    chosen = {}
+    for name, index, axes in quantizable_weights(model):
+        layer = model.get_layer(name)
+        weights = layer.get_weights()
+        w = weights[index]
+
+        errors = []
+        for percentile in percentiles:
+            weights[index] = dequantize(*quantize_per_channel(w, axes, percentile))
+            layer.set_weights(weights)
+            errors.append(np.mean(np.square(model.predict(x, batch_size=batch_size) - reference)))
+
+        chosen[name] = percentiles[int(np.argmin(errors))]
+        weights[index] = dequantize(*quantize_per_channel(w, axes, chosen[name]))
+        layer.set_weights(weights)
+        print("%s: clip at percentile %.2f (output MSE %.2e)" % (name, chosen[name], min(errors)))
+
+    model.set_weights(float_weights)
+    return chosen
+
+
+def save_quantized(model, path, percentiles):
+    """ Save all weights of model into one npz file. Quantized weights are stored as int8 with their
+        float32 scales (<layer>/<index>/q and <layer>/<index>/scale), all others as float32.
+    """
+    quantized = {(name, index): axes for name, index, axes in quantizable_weights(model)}
+    arrays = {}
+    for layer in model.layers:
+        for index, w in enumerate(layer.get_weights()):
+            key = "%s/%d" % (layer.name, index)
+            if (layer.name, index) in quantized:
+                q, scale = quantize_per_channel(w, quantized[(layer.name, index)], percentiles[layer.name])
+                arrays[key + '/q'] = q
+                arrays[key + '/scale'] = scale
+            else:
+                arrays[key] = w
+
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+    return path
+
+
+def load_quantized(model, path):
+    """ Load weights written by save_quantized. The int8 weights are dequantized once, so inference
+        runs the unchanged float32 graph (with float routing) on the int8 values. The format only
+        compresses the weights, inference is not faster.
+    """
+    arrays = np.load(path)
+    for layer in model.layers:
+        weights = layer.get_weights()
+        if not weights:
+            continue
+
+        for index in range(len(weights)):
+            key = "%s/%d" % (layer.name, index)
+            if key + '/q' in arrays:
+                weights[index] = dequantize(arrays[key + '/q'], arrays[key + '/scale'])
+            else:
+                weights[index] = arrays[key]
+        layer.set_weights(weights)
+
+
+def run(model, x_calibration, data, path, report_path=None, batch_size=100):
+    """ Calibrate, quantize and save the weights of a classification model and compare accuracy and
+        size with float32. This is weight compression only: the weights are dequantized at load time
+        and the float32 graph runs, so there is no latency comparison. The float32 weights are
+        restored afterwards.
+
+        :param model: Classification-only model, i.e. up to Length
+        :param x_calibration: A few hundred training images
+        :param data: (x_test, y_test) for the comparison
+        :param path: Path of the npz artifact
+        :param report_path: Optional JSON file for the report
+    """
+    x_test, y_test = data
+    float_weights = model.get_weights()
+    float_acc = utils.accuracy(model, x_test, y_test, batch_size)
+
+    percentiles = calibrate(model, x_calibration, batch_size=batch_size)
+    save_quantized(model, path, percentiles)
+    load_quantized(model, path)
+    int8_acc = utils.accuracy(model, x_test, y_test, batch_size)
+    model.set_weights(float_weights)
+
+    report = dict(float32_accuracy=float(float_acc), int8_accuracy=float(int8_acc),
+                  float32_mb=sum(w.nbytes for w in float_weights) / 2.**20,
+                  int8_mb=os.path.getsize(path) / 2.**20,
+                  calibration_samples=len(x_calibration), percentiles=percentiles)
+
+    print("\n%-10s %10s %10s" % ("", "accuracy", "size [MB]"))
+    print("%-10s %10.4f %10.1f" % ("float32", float_acc, report['float32_mb']))
+    print("%-10s %10.4f %10.1f" % ("int8", int8_acc, report['int8_mb']))
+    print("Note: weight compression only, the int8 weights are dequantized at load time and run in float32.")
+    print("Quantized weights saved to %s" % path)
+
+    if report_path is not None:
+        with open(report_path, 'w') as out:
+            json.dump(report, out, indent=2)
+    return report